@@ -1,5 +1,6 @@
 import _pickle as pickle
 import os
+import time
 from multiprocessing import Process, Queue
 import queue
 
@@ -10,15 +11,18 @@ import numpy as np
 from gym import spaces
 
 import utils
+import wire
+from inference import InferenceClient
 from memory import BatchStorage
 from wrapper import make_atari, wrap_atari_dqn
-from model import DuelingDQN
+from model import DuelingDQN, inference_model
 from model import RandomPolicy
 from model import ActorCritic
 from arguments import argparser
 
 from runtag.actions import *
 from runtag.envs.centralized import RunTagEnv
+from vec_env import BatchedRunTagEnv, VecRunTagEnv, SubprocRunTagEnv
 
 
 def get_environ():
@@ -31,28 +35,27 @@ def get_environ():
     return actor_id, n_actors, replay_ip, learner_ip
 
 
-def connect_param_socket(ctx, param_socket, learner_ip, actor_id):
-    socket = ctx.socket(zmq.REQ)
-    socket.connect("tcp://{}:52002".format(learner_ip))
-    socket.send(pickle.dumps((actor_id, 1)))
-    socket.recv()
-    param_socket.connect('tcp://{}:52001'.format(learner_ip))
-    socket.send(pickle.dumps((actor_id, 2)))
-    socket.recv()
-    print("Successfully connected to learner!")
-    socket.close()
-
-
 def recv_param(learner_ip, actor_id, param_queue):
     ctx = zmq.Context()
     param_socket = ctx.socket(zmq.SUB)
     param_socket.setsockopt(zmq.SUBSCRIBE, b'')
     param_socket.setsockopt(zmq.CONFLATE, 1)
-    connect_param_socket(ctx, param_socket, learner_ip, actor_id)
+    utils.connect_param_socket(ctx, param_socket, learner_ip, actor_id)
     while True:
         data = param_socket.recv(copy=False)
-        param = pickle.loads(data)
-        param_queue.put(param)
+        param_queue.put(utils.decode_params(*wire.unpack(wire.split(data))))
+
+
+def request_param(param_socket, version):
+    """
+    Ask the learner for parameters newer than version.
+    Returns the latest version and its state_dict, or None if not newer.
+    """
+    param_socket.send_multipart(wire.pack([], version=version))
+    arrays, meta = wire.unpack(param_socket.recv_multipart(copy=False))
+    if meta['version'] <= version:
+        return version, None
+    return utils.decode_params(arrays, meta)
 
 class CommanderPolicy():
     def __init__(self, model):
@@ -61,6 +64,9 @@ class CommanderPolicy():
     def next_action(self, observation, epsilon=0):
         return self.model.act(observation, epsilon)
 
+    def next_actions(self, observations, epsilons):
+        return self.model.act_batch(observations, epsilons)
+
 class SubordinatePolicy():
     def next_action(self, observation):
         direction = RunTagEnv.directions[observation['direction']]
@@ -69,11 +75,14 @@ class SubordinatePolicy():
         else:
             return RunTagEnv.from_subordinate_action(SubordinateMove(direction))
 
+    def next_actions(self, observations):
+        return [self.next_action(observation) for observation in observations]
+
 def flatten(env, observation):
     observation = torch.as_tensor(spaces.utils.flatten(env.commander_observation_space, observation), dtype=torch.float)
     return torch.reshape(observation, (1, -1))
 
-def exploration(args, actor_id, n_actors, replay_ip, param_queue):
+def exploration(args, actor_id, n_actors, replay_ip, learner_ip, inference_ip, param_queue):
     ctx = zmq.Context()
     batch_socket = ctx.socket(zmq.DEALER)
     batch_socket.setsockopt(zmq.IDENTITY, pickle.dumps('actor-{}'.format(actor_id)))
@@ -81,84 +90,120 @@ def exploration(args, actor_id, n_actors, replay_ip, param_queue):
     outstanding = 0
 
     writer = SummaryWriter(comment="-{}-actor{}".format(args.env, actor_id))
-    
-    env = RunTagEnv(width=5, height=5, number_of_subordinates=1, max_steps=1000)
+
+    if args.batched_env:
+        envs = BatchedRunTagEnv(args.n_envs, width=5, height=5, number_of_subordinates=1, max_steps=1000)
+    elif args.n_env_workers > 0:
+        envs = SubprocRunTagEnv(args.n_envs, args.n_env_workers,
+                                width=5, height=5, number_of_subordinates=1, max_steps=1000)
+    else:
+        envs = VecRunTagEnv(args.n_envs, width=5, height=5, number_of_subordinates=1, max_steps=1000)
 
     # env = make_atari(args.env)
     # env = wrap_atari_dqn(env, args)
 
     seed = args.seed + actor_id
     utils.set_global_seeds(seed, use_torch=True)
-    env.seed(seed)
+    envs.seed(args.seed + actor_id * args.n_envs)
 
-    blue_commander_model = DuelingDQN(env)
-    red_commander_model = RandomPolicy(env)
+    if args.inference_server:
+        blue_commander_model = InferenceClient(ctx, inference_ip)
+    else:
+        blue_commander_model = inference_model(DuelingDQN(envs), args.inference_backend)
+    red_commander_model = RandomPolicy(envs)
 
     blue_commander_policy = CommanderPolicy(blue_commander_model)
     red_commander_policy = CommanderPolicy(red_commander_model)
     subordinate_policy = SubordinatePolicy()
 
-    # model = DuelingDQN(env)
-    epsilon = args.eps_base ** (1 + actor_id / (n_actors - 1) * args.eps_alpha)
-    storage = BatchStorage(args.n_steps, args.gamma)
-
-    param = param_queue.get(block=True)
-    blue_commander_model.load_state_dict(param)
-    param = None
-    print("Received First Parameter!")
-
-    episode_reward, episode_length, episode_idx, actor_idx = 0, 0, 0, 0
-    states = env.reset()
+    # every env explores like one of n_actors * n_envs actors in Ape-X
+    n_explorers = n_actors * args.n_envs
+    explorer_ids = actor_id * args.n_envs + np.arange(args.n_envs)
+    epsilons = args.eps_base ** (1 + explorer_ids / max(n_explorers - 1, 1) * args.eps_alpha)
+    storages = [BatchStorage(args.n_steps, args.gamma) for _ in range(args.n_envs)]
+
+    if args.inference_server:
+        # the inference server follows the learner and reports its version
+        param_version, param = -1, None
+    elif args.param_mode == 'request':
+        param_socket = ctx.socket(zmq.REQ)
+        utils.connect_param_socket(ctx, param_socket, learner_ip, actor_id, port=52003)
+        param_version, param = request_param(param_socket, -1)
+        while param is None:
+            time.sleep(1)
+            param_version, param = request_param(param_socket, -1)
+    else:
+        param_version, param = param_queue.get(block=True)
+    if param is not None:
+        blue_commander_model.load_state_dict(param)
+        param = None
+        print("Received First Parameter!")
+
+    episode_rewards = np.zeros(args.n_envs)
+    episode_lengths = np.zeros(args.n_envs, dtype=np.int64)
+    episode_idx, actor_idx = 0, 0
+    states = envs.reset()
     while True:
-        #action, q_values = model.act(torch.FloatTensor(np.array(state[0])), epsilon)
-        state = flatten(env, states[0])
-        blue_com_action, q_values = blue_commander_policy.next_action(state, epsilon)
-        blue_sub_action = subordinate_policy.next_action(states[1])
-        red_com_action = red_commander_policy.next_action(flatten(env, states[2]))
-        red_sub_action = subordinate_policy.next_action(states[3])
-        actions = [
-                blue_com_action,
-                blue_sub_action,
-                red_com_action,
-                red_sub_action,
-            ]
-
-
-        next_states, rewards, dones, _ = env.step(actions)
-        next_state, reward, done, action = next_states[0], rewards[0], dones[0], actions[0]
-        # print('state:', state)
-        storage.add(state, reward, action, done, q_values)
+        # one forward pass for the blue commanders of all envs
+        blue_states = states[0]
+        blue_com_actions, q_values = blue_commander_policy.next_actions(torch.from_numpy(blue_states), epsilons)
+        red_com_actions = red_commander_policy.next_actions(states[2], epsilons)
+        if args.inference_server:
+            param_version = blue_commander_model.param_version
+        actions = np.stack([
+                blue_com_actions,
+                subordinate_policy.next_actions(states[1]),
+                red_com_actions,
+                subordinate_policy.next_actions(states[3]),
+            ], axis=1)
+
+        next_states, rewards, dones, _ = envs.step(actions)
+        for i, storage in enumerate(storages):
+            storage.add(blue_states[i], rewards[i, 0], blue_com_actions[i], dones[i], q_values[i])
 
         states = next_states
-        episode_reward += reward
-        episode_length += 1
+        episode_rewards += rewards[:, 0]
+        episode_lengths += 1
         actor_idx += 1
 
-        if done or episode_length == args.max_episode_length:
-            state = env.reset()
-            writer.add_scalar("actor/episode_reward", episode_reward, episode_idx)
-            writer.add_scalar("actor/episode_length", episode_length, episode_idx)
-            episode_reward = 0
-            episode_length = 0
+        # envs reset themselves when done
+        for i in np.flatnonzero(dones | (episode_lengths == args.max_episode_length)):
+            if not dones[i]:
+                # cut short, so the pending steps of storage have no n-step return
+                storages[i].end_episode()
+                states = envs.reset_at(i)
+            writer.add_scalar("actor/episode_reward", episode_rewards[i], episode_idx)
+            writer.add_scalar("actor/episode_length", episode_lengths[i], episode_idx)
+            episode_rewards[i] = 0
+            episode_lengths[i] = 0
             episode_idx += 1
 
-        if actor_idx % args.update_interval == 0:
-            try:
-                param = param_queue.get(block=False)
-                model.load_state_dict(param)
+        if not args.inference_server and actor_idx % args.update_interval == 0:
+            if args.param_mode == 'request':
+                param_version, param = request_param(param_socket, param_version)
+            else:
+                try:
+                    param_version, param = param_queue.get(block=False)
+                except queue.Empty:
+                    pass
+            if param is not None:
+                blue_commander_model.load_state_dict(param)
+                writer.add_scalar("actor/param_version", param_version, actor_idx)
+                param = None
                 print("Updated Parameter..")
-            except queue.Empty:
-                pass
 
-        if len(storage) == args.send_interval:
-            batch, prios = storage.make_batch()
-            data = pickle.dumps((batch, prios))
+        for storage in storages:
+            if len(storage) < args.send_interval:
+                continue
+            batch, prios = storage.make_compact_batch()
+            frames = wire.pack(batch + [prios], param_version=param_version)
             batch, prios = None, None
             storage.reset()
             while outstanding >= args.max_outstanding:
                 batch_socket.recv()
                 outstanding -= 1
-            batch_socket.send(data, copy=False)
+            batch_socket.send_multipart(frames, copy=False)
+            frames = None
             outstanding += 1
             print("Sending Batch..")
 
@@ -167,12 +212,15 @@ def main():
     actor_id, n_actors, replay_ip, learner_ip = get_environ()
     #actor_id, n_actors, replay_ip, learner_ip = 0, 2, '127.0.0.1', '127.0.0.1'
     args = argparser()
+    inference_ip = os.environ.get('INFERENCE_IP', learner_ip)
     param_queue = Queue(maxsize=3)
 
     procs = [
-        Process(target=exploration, args=(args, actor_id, n_actors, replay_ip, param_queue)),
-        Process(target=recv_param, args=(learner_ip, actor_id, param_queue)),
+        Process(target=exploration,
+                args=(args, actor_id, n_actors, replay_ip, learner_ip, inference_ip, param_queue)),
     ]
+    if args.param_mode == 'publish' and not args.inference_server:
+        procs.append(Process(target=recv_param, args=(learner_ip, actor_id, param_queue)))
 
     for p in procs:
         p.start()
@@ -34,6 +34,21 @@ def argparser():
                         help='Maximum length of episode')
     parser.add_argument('--max_outstanding', type=int, default=3,
                         help='Maximum number of outstanding batch push requests')
+    parser.add_argument('--n_envs', type=int, default=1,
+                        help='Number of environments an actor steps in lockstep')
+    parser.add_argument('--n_env_workers', type=int, default=0,
+                        help='Number of processes stepping the envs of an actor, '
+                             '0 steps them in the actor process')
+    parser.add_argument('--batched_env', action='store_true', default=False,
+                        help='Simulate the envs of an actor together in NumPy arrays')
+    parser.add_argument('--inference_server', action='store_true', default=False,
+                        help='Get actions from inference.py instead of a local model')
+    parser.add_argument('--inference_backend', type=str, default='eager', choices=['eager', 'traced', 'numpy'],
+                        help='Run the local model as is(eager), as a TorchScript trace(traced) '
+                             'or in NumPy with cached weights(numpy)')
+    parser.add_argument('--param_mode', type=str, default='publish', choices=['publish', 'request'],
+                        help='Receive every parameter publish(publish) or request the latest '
+                             'version every update_interval steps(request)')
     parser.add_argument('--eps_base', type=float, default=0.4)
     parser.add_argument('--eps_alpha', type=float, default=7.0)
 
@@ -48,6 +63,13 @@ def argparser():
                         help='Threshold for starting to transfer batches to learner')
     parser.add_argument('--batch_size', type=int, default=512,
                         help='Size of samples prefetched batches will contain')
+    parser.add_argument('--replay_storage', type=str, default='compact',
+                        choices=['tuple', 'array', 'compact'],
+                        help='Layout of replay storage. tuple keeps one Python tuple per transition, '
+                             'array keeps preallocated NumPy columns, compact additionally '
+                             'stores next states as offsets to shared observations')
+    parser.add_argument('--n_replay_shards', type=int, default=1,
+                        help='Number of processes the replay buffer is split over')
     parser.add_argument('--n_recv_batch_worker', type=int, default=4)
     parser.add_argument('--n_recv_prios_worker', type=int, default=4)
     parser.add_argument('--n_send_batch_worker', type=int, default=8)
@@ -62,10 +84,16 @@ def argparser():
                         help='Maximum gradient norm to clip')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='Enables CUDA training')
+    parser.add_argument('--n_batches_per_step', type=int, default=1,
+                        help='Number of prefetched batches concatenated into one update. '
+                             'Intervals of the learner count batches, so they keep their '
+                             'meaning in samples')
     parser.add_argument('--target_update_interval', type=int, default=2500,
                         help='Interval of updating target network')
     parser.add_argument('--publish_param_interval', type=int, default=25,
                         help='Interval of publishing parameter to actors')
+    parser.add_argument('--param_precision', type=str, default='fp32', choices=['fp32', 'fp16', 'int8'],
+                        help='Precision of parameters sent to actors')
     parser.add_argument('--save_interval', type=int, default=5000,
                         help='Interval of saving model parameters')
     parser.add_argument('--bps_interval', type=int, default=100,
@@ -73,6 +101,12 @@ def argparser():
     parser.add_argument('--n_recv_batch_process', type=int, default=4,
                         help='Number of processes to receive batch from replay')
 
+    # Arguments for Inference Server
+    parser.add_argument('--inference_max_batch', type=int, default=256,
+                        help='Maximum number of states in one forward pass')
+    parser.add_argument('--inference_max_wait', type=float, default=2.0,
+                        help='Maximum milliseconds a request waits for a batch to fill')
+
     # Arguments for Evaluation
     parser.add_argument('--render', action='store_true', default=False)
 
@@ -0,0 +1,549 @@
+"""
+Module for micro-benchmarks of Ape-X components.
+
+    python benchmark.py replay_lock
+    python benchmark.py wire
+    python benchmark.py actor_envs
+    python benchmark.py runtag_steps --width 20 --height 20 --n_subordinates 8
+    python benchmark.py batched_env_check --check_steps 2000
+    python benchmark.py batched_env --n_envs 16 256 4096
+    python benchmark.py learner_bps
+    python benchmark.py act_consistency --n_envs 1 16 256
+    python benchmark.py inference_latency --n_envs 1 16 256
+    python benchmark.py learner_samples --batch_size 512 --n_batches_per_step 1 2 4 8
+"""
+import _pickle as pickle
+import argparse
+import random
+import threading
+import time
+
+import numpy as np
+import torch
+import zmq
+
+import utils
+import wire
+from actor import CommanderPolicy, SubordinatePolicy
+from learner import BatchSlots
+from memory import BatchStorage, CompactPrioritizedReplayBuffer, ConcurrentReplayBuffer
+from model import DuelingDQN, RandomPolicy, INFERENCE_BACKENDS, inference_model
+from vec_env import BatchedRunTagEnv, VecRunTagEnv, SubprocRunTagEnv
+from runtag.envs.centralized import RunTagEnv
+
+
+def make_filled_buffer(size, n_transitions, state_dim=62, alpha=0.6):
+    buffer = CompactPrioritizedReplayBuffer(size, alpha, (state_dim, ))
+    for batch, prios in actor_batches(n_transitions // 50, state_dim):
+        buffer.add_batch(*batch, prios)
+    return buffer
+
+
+def actor_batches(n_batches, state_dim=62, send_interval=50, n_steps=3):
+    """
+    Yield batches shaped like BatchStorage.make_batch with n-step next states
+    shared with the states of the same batch
+    """
+    for _ in range(n_batches):
+        observations = list(np.random.rand(send_interval + n_steps, 1, state_dim).astype(np.float32))
+        batch = [observations[:send_interval],
+                 list(np.random.randint(11, size=send_interval)),
+                 list(np.random.rand(send_interval).astype(np.float32)),
+                 observations[n_steps:],
+                 list(np.zeros(send_interval, dtype=np.float32))]
+        yield batch, np.random.rand(send_interval) + 1e-6
+
+
+class GlobalLockBuffer:
+    """
+    The scheme replay.py used before ConcurrentReplayBuffer: one lock around
+    every buffer call, including serialization of sampled batches.
+    """
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._lock = threading.Lock()
+
+    def add_batch(self, *args):
+        with self._lock:
+            self._buffer.add_batch(*args)
+
+    def update_priorities(self, idxes, priorities):
+        with self._lock:
+            self._buffer.update_priorities(idxes, priorities)
+
+    def sample_and_dump(self, batch_size, beta):
+        with self._lock:
+            return pickle.dumps(self._buffer.sample(batch_size, beta))
+
+
+class ConcurrentBuffer(ConcurrentReplayBuffer):
+    def sample_and_dump(self, batch_size, beta):
+        return pickle.dumps(self.sample(batch_size, beta))
+
+
+def replay_lock(args):
+    """
+    Sampling throughput of the replay buffer while actors insert batches and
+    the learner updates priorities, for a growing number of sampling threads
+    """
+    batches = list(actor_batches(200))
+    base = make_filled_buffer(args.replay_buffer_size, args.n_transitions)
+
+    for wrapper in (GlobalLockBuffer, ConcurrentBuffer):
+        for n_workers in args.n_workers:
+            buffer = wrapper(base)
+            stop = threading.Event()
+            counts = [0] * n_workers
+            writes = [0]
+
+            def sampler(idx):
+                while not stop.is_set():
+                    buffer.sample_and_dump(args.batch_size, 0.4)
+                    counts[idx] += 1
+
+            def writer():
+                cnt = 0
+                while not stop.is_set():
+                    batch, prios = batches[cnt % len(batches)]
+                    buffer.add_batch(*batch, prios)
+                    if cnt % 10 == 0:
+                        idxes = np.random.randint(len(base), size=args.batch_size)
+                        buffer.update_priorities(idxes, np.random.rand(args.batch_size) + 1e-6)
+                    cnt += 1
+                    writes[0] = cnt
+                    time.sleep(args.write_interval)
+
+            threads = [threading.Thread(target=sampler, args=(i, )) for i in range(n_workers)]
+            threads.append(threading.Thread(target=writer))
+            for t in threads:
+                t.start()
+            time.sleep(args.duration)
+            stop.set()
+            for t in threads:
+                t.join()
+            print("{:18} workers: {:2} / sampled batches/s: {:8.1f} / inserted batches/s: {:8.1f}".format(
+                wrapper.__name__, n_workers, sum(counts) / args.duration, writes[0] / args.duration))
+
+
+def wire_format(args):
+    """
+    Round trip of a sampled batch from replay to learner over a local socket,
+    pickled as before against the framed format of wire.py
+    """
+    base = make_filled_buffer(args.replay_buffer_size, args.n_transitions)
+    batch = base.sample(args.batch_size, 0.4)
+    ctx = zmq.Context()
+    sender, receiver = ctx.socket(zmq.PAIR), ctx.socket(zmq.PAIR)
+    sender.bind('inproc://wire')
+    receiver.connect('inproc://wire')
+
+    def pickled():
+        sender.send(pickle.dumps(batch), copy=False)
+        states, *_ = pickle.loads(receiver.recv(copy=False))
+        return np.array([np.array(state) for state in states])
+
+    def framed():
+        sender.send_multipart(wire.pack(batch), copy=False)
+        (states, *_), _ = wire.unpack(receiver.recv_multipart(copy=False))
+        return states
+
+    for name, round_trip in (('pickle', pickled), ('wire', framed)):
+        n, ts = 0, time.time()
+        while time.time() - ts < args.duration:
+            round_trip()
+            n += 1
+        print("{:8} batches/s: {:8.1f} / ms per batch: {:.3f}".format(
+            name, n / args.duration, 1000 * args.duration / n))
+    ctx.destroy()
+
+
+def actor_envs(args):
+    """
+    Env steps per second of the actor loop (policies, env step and
+    BatchStorage) for a growing number of envs stepped in lockstep
+    """
+    torch.set_num_threads(1)
+    for n_envs in args.n_envs:
+        if args.n_env_workers > 0:
+            envs = SubprocRunTagEnv(n_envs, args.n_env_workers, max_steps=1000)
+        else:
+            envs = VecRunTagEnv(n_envs, max_steps=1000)
+        blue_policy = CommanderPolicy(DuelingDQN(envs))
+        red_policy = CommanderPolicy(RandomPolicy(envs))
+        subordinate_policy = SubordinatePolicy()
+        storages = [BatchStorage(3, 0.99) for _ in range(n_envs)]
+        epsilons = np.full(n_envs, 0.1)
+
+        states = envs.reset()
+        n, ts = 0, time.time()
+        while time.time() - ts < args.duration:
+            blue_actions, q_values = blue_policy.next_actions(torch.from_numpy(states[0]), epsilons)
+            actions = np.stack([blue_actions,
+                                subordinate_policy.next_actions(states[1]),
+                                red_policy.next_actions(states[2], epsilons),
+                                subordinate_policy.next_actions(states[3])], axis=1)
+            next_states, rewards, dones, _ = envs.step(actions)
+            for i, storage in enumerate(storages):
+                storage.add(states[0][i], rewards[i, 0], blue_actions[i], dones[i], q_values[i])
+                if len(storage) == 50:
+                    storage.reset()
+            states = next_states
+            n += n_envs
+        print("envs: {:4} / env steps/s: {:8.1f}".format(n_envs, n / (time.time() - ts)))
+        if args.n_env_workers > 0:
+            envs.close()
+
+
+def runtag_steps(args):
+    """
+    RunTagEnv steps per second with uniformly random actions, and with
+    moves and observations only, which leaves out the radio Station
+    """
+    env = RunTagEnv(width=args.width, height=args.height,
+                    number_of_subordinates=args.n_subordinates, max_steps=1000)
+    n_commander_actions = env.commander_action_space.n
+    n_subordinate_actions = env.subordinate_action_space.n
+    for name, commander_actions, subordinate_actions in (
+            ('random', n_commander_actions, n_subordinate_actions),
+            ('no radio', 1 + len(env.directions), [1, 2, 3, 4, 5])):
+        # drawn up front, so the loop times the env only
+        random_state = np.random.RandomState(args.seed)
+        commanders = random_state.choice(commander_actions, size=(2 ** 16, 2)).tolist()
+        subordinates = random_state.choice(subordinate_actions, size=(2 ** 16, 2, args.n_subordinates)).tolist()
+        actions = [[blue] + blue_subordinates + [red] + red_subordinates
+                   for (blue, red), (blue_subordinates, red_subordinates) in zip(commanders, subordinates)]
+        env.reset()
+        n, ts = 0, time.time()
+        while time.time() - ts < args.duration:
+            _, _, dones, _ = env.step(actions[n % len(actions)])
+            if dones[0]:
+                env.reset()
+            n += 1
+        print("{:8} / env steps/s: {:8.1f}".format(name, n / (time.time() - ts)))
+
+
+def random_actions(env, n_steps, random_state):
+    """
+    (n_steps, K, number_of_agents) uniformly random actions for the envs of env
+    """
+    sizes = [env.commander_action_space.n if index % env.number_of_agents_per_camp == 0
+             else env.subordinate_action_space.n for index in range(env.number_of_agents)]
+    return random_state.randint(sizes, size=(n_steps, env.n_envs, env.number_of_agents))
+
+
+def same_observations(left, right):
+    return all(np.array_equal(a, b) if isinstance(a, np.ndarray) else a == b for a, b in zip(left, right))
+
+
+def batched_env_check(args):
+    """
+    Differential test of BatchedRunTagEnv against VecRunTagEnv on uniformly
+    random actions. Fails on the first step whose observations, rewards,
+    dones or infos differ
+    """
+    n_envs, n_steps = 16, args.check_steps
+    envs = [VecRunTagEnv(n_envs, max_steps=100), BatchedRunTagEnv(n_envs, max_steps=100)]
+    actions = random_actions(envs[0], n_steps, np.random.RandomState(args.seed))
+    random.seed(args.seed)
+    state = random.getstate()
+    results = []
+    for env in envs:
+        # both envs lay out games with the random module, so each starts from the same state
+        random.setstate(state)
+        results.append(env.reset())
+    assert same_observations(*results), 'observations differ after reset'
+    for n, step_actions in enumerate(actions):
+        results = []
+        for env in envs:
+            random.setstate(state)
+            results.append(env.step(step_actions))
+        state = random.getstate()
+        (observations, rewards, dones, infos), (batched_observations, *batched) = results
+        assert same_observations(observations, batched_observations), 'observations differ at step {}'.format(n)
+        assert np.array_equal(rewards, batched[0]), 'rewards differ at step {}'.format(n)
+        assert np.array_equal(dones, batched[1]), 'dones differ at step {}'.format(n)
+        assert infos == batched[2], 'infos differ at step {}'.format(n)
+    print("differential check / envs: {} / steps: {} / passed".format(n_envs, n_steps))
+
+
+def batched_env(args):
+    """
+    Env steps per second of VecRunTagEnv and BatchedRunTagEnv for a growing
+    number of envs, see batched_env_check for their equivalence
+    """
+    for n_envs in args.n_envs:
+        vec, batched = VecRunTagEnv(n_envs, max_steps=1000), BatchedRunTagEnv(n_envs, max_steps=1000)
+        for name, env, step in (('vec', vec, vec.step), ('batched', batched, batched.step),
+                                ('arrays', batched, batched.step_arrays)):
+            actions = random_actions(env, 64, np.random.RandomState(args.seed))
+            env.reset()
+            n, ts = 0, time.time()
+            while time.time() - ts < args.duration:
+                step(actions[n % len(actions)])
+                n += 1
+            print("{:8} envs: {:6} / env steps/s: {:10.1f}".format(name, n_envs, n * n_envs / (time.time() - ts)))
+
+
+def learner_batches(n_batches, batch_size, observation_size, n_actions):
+    """
+    Random batches shaped like BatchSlots.get
+    """
+    return [[torch.rand(batch_size, observation_size), torch.randint(n_actions, (batch_size, )),
+             torch.rand(batch_size), torch.rand(batch_size, observation_size),
+             (torch.rand(batch_size) < 0.01).float(), torch.rand(batch_size)]
+            for _ in range(n_batches)]
+
+
+def separate_passes_loss(model, tgt_model, batch, n_steps, gamma=0.99):
+    """
+    utils.compute_loss before it ran the next-state passes under no_grad:
+    three forward passes recorded for backward and a torch.where Huber loss
+    """
+    states, actions, rewards, next_states, dones, weights = batch
+
+    q_values = model(states)
+    next_q_values = model(next_states)
+    tgt_next_q_values = tgt_model(next_states)
+
+    next_actions = next_q_values.max(1)[1].unsqueeze(1)
+    q_a_values = q_values.gather(1, actions.unsqueeze(1)).squeeze(1)
+    next_q_a_values = tgt_next_q_values.gather(1, next_actions).squeeze(1)
+    expected_q_a_values = rewards + (gamma ** n_steps) * next_q_a_values * (1 - dones)
+
+    td_error = torch.abs(expected_q_a_values.detach() - q_a_values)
+    prios = (td_error + 1e-6).data.cpu().numpy()
+
+    loss = torch.where(td_error < 1, 0.5 * td_error ** 2, td_error - 0.5)
+    loss = (loss * weights).mean()
+    return loss, prios
+
+
+def per_parameter_update(loss, model, optimizer, max_norm):
+    """
+    utils.update_parameters before it reused the norm of clip_grad_norm_:
+    a norm per parameter summed in Python, logged every step as learner.train
+    did, with RMSprop stepping parameter by parameter
+    """
+    optimizer.zero_grad()
+    loss.backward()
+    total_norm = 0.
+    for p in model.parameters():
+        param_norm = p.grad.data.norm(2)
+        total_norm += param_norm ** (1. / 2)
+    total_norm = total_norm ** (1. / 2)
+    torch.nn.utils.clip_grad.clip_grad_norm_(model.parameters(), max_norm)
+    optimizer.step()
+    return loss.item(), total_norm.item()
+
+
+def make_models(args, n_models=1):
+    """
+    n_models DuelingDQN of the 5x5 RunTagEnv the learner trains on, seeded
+    with args.seed, with torch on args.n_threads threads
+    """
+    torch.set_num_threads(args.n_threads)
+    env = RunTagEnv(width=5, height=5, number_of_subordinates=1, max_steps=1000)
+    torch.manual_seed(args.seed)
+    return [DuelingDQN(env) for _ in range(n_models)]
+
+
+def best_of_rounds(calls, duration, n_calls=10, prepare=None):
+    """
+    Best mean seconds per call of every call(n) of calls, a dict by name,
+    over short rounds of n_calls alternating between them until duration
+    has passed, since CPU timings drift. prepare(name, n) runs untimed
+    before every call if given
+    """
+    best = {name: float('inf') for name in calls}
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for name, call in calls.items():
+            elapsed = 0.
+            for n in range(n_calls):
+                if prepare is not None:
+                    prepare(name, n)
+                ts = time.perf_counter()
+                call(n)
+                elapsed += time.perf_counter() - ts
+            best[name] = min(best[name], elapsed / n_calls)
+    return best
+
+
+def learner_bps(args):
+    """
+    Learner updates per second (the BPS of learner.train) on CPU: the loss
+    of separate_passes_loss against utils.compute_loss, then
+    per_parameter_update against utils.update_parameters with a foreach
+    RMSprop. Checks the returned norm is the norm of all gradients first
+    """
+    model, tgt_model = make_models(args, 2)
+    batches = learner_batches(8, args.batch_size, model.observation_size, model.num_actions)
+    prios_buffers = utils.PriorityBuffers(2)
+
+    def rmsprop(foreach):
+        return torch.optim.RMSprop(model.parameters(), 6.25e-5, alpha=0.95, eps=1.5e-7,
+                                   centered=True, foreach=foreach)
+
+    loss, _ = utils.compute_loss(model, tgt_model, batches[0], 3)
+    grad_norm = utils.update_parameters(loss, model, torch.optim.SGD(model.parameters(), 0.), float('inf'))
+    expected = torch.cat([p.grad.flatten() for p in model.parameters()]).norm(2)
+    print("grad norm: {:.6f} / expected: {:.6f}".format(float(grad_norm), float(expected)))
+
+    def no_grad_loss(*loss_args):
+        return utils.compute_loss(*loss_args, prios_buffers=prios_buffers)
+
+    def update(compute_loss, update_parameters, optimizer):
+        def call(n):
+            loss, prios = compute_loss(model, tgt_model, batches[n % len(batches)], 3, 0.99)
+            update_parameters(loss, model, optimizer, 40.0)
+        return call
+
+    best = best_of_rounds({
+        'separate': update(separate_passes_loss, per_parameter_update, rmsprop(False)),
+        'no_grad': update(no_grad_loss, per_parameter_update, rmsprop(False)),
+        'foreach': update(no_grad_loss, utils.update_parameters, rmsprop(True)),
+    }, args.duration)
+    for name, seconds in best.items():
+        print("{:8} batch size: {:5} / BPS: {:8.2f}".format(name, args.batch_size, 1 / seconds))
+
+
+def learner_samples(args):
+    """
+    Learner samples per second on CPU with n_batches_per_step batches of
+    batch_size concatenated into every update, from BatchSlots.get_many to
+    the optimizer step. Filling the slots, the work of recv_batch, is not
+    timed. Checks first that get_many returns the batches in slot order
+    """
+    model, tgt_model = make_models(args, 2)
+    optimizer = torch.optim.RMSprop(model.parameters(), 6.25e-5, alpha=0.95, eps=1.5e-7,
+                                    centered=True, foreach=True)
+    n_slots = max(args.n_batches_per_step)
+    slots = BatchSlots(n_slots, args.batch_size, model.observation_size)
+    prios_buffers = utils.PriorityBuffers(2)
+    batches = [[tensor.numpy() for tensor in batch] + [np.arange(n * args.batch_size, (n + 1) * args.batch_size)]
+               for n, batch in enumerate(learner_batches(n_slots, args.batch_size,
+                                                         model.observation_size, model.num_actions))]
+
+    for batch in batches:
+        slots.put(batch)
+    taken, batch, idxes = slots.get_many(n_slots, 'cpu')
+    expected = [np.concatenate([batches[slot][column] for slot in taken]) for column in range(len(batch))]
+    same = all(np.array_equal(tensor.numpy(), array) for tensor, array in zip(batch, expected))
+    print("concatenated batches match: {} / idxes match: {}".format(
+        same, np.array_equal(idxes, np.concatenate([batches[slot][-1] for slot in taken]))))
+    for slot in taken:
+        slots.release(slot)
+
+    def fill(n_batches, n):
+        for batch in batches[:n_batches]:
+            slots.put(batch)
+
+    def update(n_batches):
+        def call(n):
+            taken, batch, idxes = slots.get_many(n_batches, 'cpu')
+            loss, prios = utils.compute_loss(model, tgt_model, batch, 3, 0.99, prios_buffers)
+            utils.update_parameters(loss, model, optimizer, 40.0)
+            for slot in taken:
+                slots.release(slot)
+        return call
+
+    best = best_of_rounds({n_batches: update(n_batches) for n_batches in args.n_batches_per_step},
+                          args.duration, prepare=fill)
+    for n_batches, seconds in best.items():
+        print("batches per step: {:3} / batch size: {:5} / updates/s: {:8.2f} / samples/s: {:10.1f}".format(
+            n_batches, args.batch_size, 1 / seconds, n_batches * args.batch_size / seconds))
+
+
+def act_consistency(args, tolerance=1e-5):
+    """
+    Consistency test of act_batch against act for every backend of
+    model.inference_model. Over n_envs states, act_batch must give each
+    state the q values and greedy action act gives it alone, whatever the
+    other states of the batch: the dueling aggregation averages over
+    actions, not over the batch. Fails on the first backend and n_envs
+    that differ
+    """
+    model, = make_models(args)
+    for backend in INFERENCE_BACKENDS:
+        policy = inference_model(model, backend)
+        for n_envs in args.n_envs:
+            states = torch.rand(n_envs, model.observation_size)
+            actions, q_values = policy.act_batch(states, np.zeros(n_envs))
+            singles = [policy.act(state, 0.) for state in states]
+            single_actions = np.array([action for action, _ in singles])
+            single_q_values = np.stack([q for _, q in singles])
+            # the same states in reverse order, next to other states
+            _, reversed_q_values = policy.act_batch(states.flip(0), np.zeros(n_envs))
+            error = np.abs(q_values - single_q_values).max()
+            reversed_error = np.abs(reversed_q_values[::-1] - q_values).max()
+            print("{:6} envs: {:5} / max q error: {:.2e} / reversed max q error: {:.2e}".format(
+                backend, n_envs, error, reversed_error))
+            where = '{} over {} states'.format(backend, n_envs)
+            assert error <= tolerance, 'act_batch q values differ from act, ' + where
+            assert reversed_error <= tolerance, 'q values depend on the batch, ' + where
+            assert np.array_equal(actions, single_actions), 'act_batch actions differ from act, ' + where
+    print("act consistency / backends: {} / envs: {} / passed".format(len(INFERENCE_BACKENDS), args.n_envs))
+
+
+def inference_latency(args):
+    """
+    Latency of one act call and of one act_batch call over n_envs states,
+    as actors make them, for every backend of model.inference_model.
+    See act_consistency for their equivalence
+    """
+    model, = make_models(args)
+    backends = {backend: inference_model(model, backend) for backend in INFERENCE_BACKENDS}
+    states = torch.rand(max(args.n_envs), model.observation_size)
+    duration = args.duration / (len(args.n_envs) + 1)
+
+    state = states[:1]
+    best = best_of_rounds({backend: lambda n, policy=policy: policy.act(state, 0.1)
+                           for backend, policy in backends.items()}, duration, n_calls=50)
+    for backend, seconds in best.items():
+        print("{:6} {:20} / {:8.1f} us".format(backend, 'act', seconds * 1e6))
+    for n_envs in args.n_envs:
+        batch, epsilons = states[:n_envs], np.full(n_envs, 0.1)
+        best = best_of_rounds({backend: lambda n, policy=policy: policy.act_batch(batch, epsilons)
+                               for backend, policy in backends.items()}, duration, n_calls=50)
+        for backend, seconds in best.items():
+            print("{:6} {:20} / {:8.1f} us".format(backend, 'act_batch envs: {:5}'.format(n_envs), seconds * 1e6))
+
+
+BENCHMARKS = {
+    'replay_lock': replay_lock,
+    'wire': wire_format,
+    'actor_envs': actor_envs,
+    'runtag_steps': runtag_steps,
+    'batched_env': batched_env,
+    'batched_env_check': batched_env_check,
+    'learner_bps': learner_bps,
+    'learner_samples': learner_samples,
+    'act_consistency': act_consistency,
+    'inference_latency': inference_latency,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ape-X benchmarks')
+    parser.add_argument('name', choices=sorted(BENCHMARKS))
+    parser.add_argument('--replay_buffer_size', type=int, default=2 ** 20)
+    parser.add_argument('--n_transitions', type=int, default=500000)
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument('--n_workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--n_envs', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--n_batches_per_step', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--n_env_workers', type=int, default=0)
+    parser.add_argument('--write_interval', type=float, default=0.005)
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--width', type=int, default=5)
+    parser.add_argument('--height', type=int, default=5)
+    parser.add_argument('--n_subordinates', type=int, default=1)
+    parser.add_argument('--check_steps', type=int, default=500)
+    parser.add_argument('--n_threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1122)
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
+
+
+if __name__ == '__main__':
+    main()
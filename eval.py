@@ -1,7 +1,6 @@
 """
 Module for evaluator in Ape-X.
 """
-import _pickle as pickle
 import os
 from multiprocessing import Process, Queue
 
@@ -11,8 +10,9 @@ from tensorboardX import SummaryWriter
 import numpy as np
 
 import utils
+import wire
 from wrapper import make_atari, wrap_atari_dqn
-from model import DuelingDQN
+from model import DuelingDQN, inference_model
 from arguments import argparser
 
 
@@ -22,27 +22,15 @@ def get_environ():
     return learner_ip
 
 
-def connect_param_socket(ctx, param_socket, learner_ip, actor_id):
-    socket = ctx.socket(zmq.REQ)
-    socket.connect("tcp://{}:52002".format(learner_ip))
-    socket.send(pickle.dumps((actor_id, 1)))
-    socket.recv()
-    param_socket.connect('tcp://{}:52001'.format(learner_ip))
-    socket.send(pickle.dumps((actor_id, 2)))
-    socket.recv()
-    print("Successfully connected to learner!")
-    socket.close()
-
-
 def recv_param(learner_ip, actor_id, param_queue):
     ctx = zmq.Context()
     param_socket = ctx.socket(zmq.SUB)
     param_socket.setsockopt(zmq.SUBSCRIBE, b'')
     param_socket.setsockopt(zmq.CONFLATE, 1)
-    connect_param_socket(ctx, param_socket, learner_ip, actor_id)
+    utils.connect_param_socket(ctx, param_socket, learner_ip, actor_id)
     while True:
         data = param_socket.recv(copy=False)
-        param = pickle.loads(data)
+        _, param = utils.decode_params(*wire.unpack(wire.split(data)))
         param_queue.put(param)
 
 
@@ -57,7 +45,7 @@ def exploration(args, actor_id, param_queue):
     utils.set_global_seeds(seed, use_torch=True)
     env.seed(seed)
 
-    model = DuelingDQN(env)
+    model = inference_model(DuelingDQN(env), args.inference_backend)
 
     param = param_queue.get(block=True)
     model.load_state_dict(param)
@@ -0,0 +1,126 @@
+"""
+Module for the batched inference server of Ape-X actors.
+
+Actors started with --inference_server send the observations of their
+envs here instead of keeping their own model. Requests from all actors
+are batched up to --inference_max_batch rows or --inference_max_wait ms,
+answered with one forward pass, and the server alone follows the learner
+parameters, so the learner expects one connection from it
+(run the learner with N_ACTORS counting the server instead of the actors).
+
+    LEARNER_IP=127.0.0.1 python inference.py
+"""
+import os
+import time
+
+import numpy as np
+import torch
+import zmq
+
+import utils
+import wire
+from model import DuelingDQN, inference_model
+from arguments import argparser
+
+from runtag.envs.centralized import RunTagEnv
+
+
+def get_environ():
+    learner_ip = os.environ.get('LEARNER_IP', '-1')
+    assert learner_ip != '-1'
+    return learner_ip
+
+
+class InferenceClient:
+    """
+    Actor-side stand-in for the model, see DuelingDQN.act_batch
+    """
+    def __init__(self, ctx, inference_ip):
+        self.socket = ctx.socket(zmq.REQ)
+        self.socket.connect('tcp://{}:53001'.format(inference_ip))
+        self.param_version = -1
+
+    def act_batch(self, states, epsilons):
+        states = np.asarray(states, dtype=np.float32)
+        epsilons = np.asarray(epsilons, dtype=np.float32)
+        self.socket.send_multipart(wire.pack([states, epsilons]), copy=False)
+        (actions, q_values), meta = wire.unpack(self.socket.recv_multipart(copy=False))
+        self.param_version = meta['param_version']
+        return actions, q_values
+
+
+def serve(args, learner_ip):
+    ctx = zmq.Context()
+    socket = ctx.socket(zmq.ROUTER)
+    socket.bind('tcp://*:53001')
+    param_socket = ctx.socket(zmq.SUB)
+    param_socket.setsockopt(zmq.SUBSCRIBE, b'')
+    param_socket.setsockopt(zmq.CONFLATE, 1)
+    utils.connect_param_socket(ctx, param_socket, learner_ip, -2)
+
+    env = RunTagEnv(width=5, height=5, number_of_subordinates=1, max_steps=1000)
+    model = inference_model(DuelingDQN(env), args.inference_backend)
+    param_version, param = utils.decode_params(*wire.unpack(wire.split(param_socket.recv(copy=False))))
+    model.load_state_dict(param)
+    print("Received First Parameter!")
+
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    poller.register(param_socket, zmq.POLLIN)
+
+    # requests waiting for the next forward pass: (identity, null, states, epsilons)
+    pending, n_rows, deadline = [], 0, None
+    n_batches, n_served, ts = 0, 0, time.time()
+    while True:
+        timeout = None if deadline is None else max(0., deadline - time.time()) * 1000
+        events = dict(poller.poll(timeout))
+
+        if param_socket in events:
+            param_version, param = utils.decode_params(*wire.unpack(wire.split(param_socket.recv(copy=False))))
+            model.load_state_dict(param)
+            param = None
+
+        while socket in events:
+            try:
+                identity, null, *frames = socket.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+            (states, epsilons), _ = wire.unpack(frames)
+            pending.append((identity, null, states, epsilons))
+            n_rows += len(states)
+            if deadline is None:
+                deadline = time.time() + args.inference_max_wait / 1000
+            if n_rows >= args.inference_max_batch:
+                break
+
+        if pending and (n_rows >= args.inference_max_batch or time.time() >= deadline):
+            states = torch.from_numpy(np.concatenate([request[2] for request in pending]))
+            epsilons = np.concatenate([request[3] for request in pending])
+            actions, q_values = model.act_batch(states, epsilons)
+            start = 0
+            for identity, null, states, _ in pending:
+                stop = start + len(states)
+                frames = wire.pack([actions[start:stop], q_values[start:stop]], param_version=param_version)
+                socket.send_multipart([identity, null] + frames, copy=False)
+                start = stop
+            n_batches += 1
+            n_served += n_rows
+            pending, n_rows, deadline = [], 0, None
+
+        if time.time() - ts > 10:
+            print("Forward passes/s: {:.2f} / Rows per pass: {:.1f}".format(
+                n_batches / (time.time() - ts), n_served / max(n_batches, 1)))
+            n_batches, n_served, ts = 0, 0, time.time()
+
+
+def main():
+    learner_ip = get_environ()
+    args = argparser()
+    utils.set_global_seeds(args.seed, use_torch=True)
+    torch.set_num_threads(1)
+    serve(args, learner_ip)
+
+
+if __name__ == '__main__':
+    os.environ["OMP_NUM_THREADS"] = "1"
+    main()
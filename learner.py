@@ -11,11 +11,11 @@ import torch
 import torch.multiprocessing as mp
 from torch.multiprocessing import Process, Queue
 from tensorboardX import SummaryWriter
-import numpy as np
 import zmq
 from gym import spaces
 
 import utils
+import wire
 import wrapper
 from model import DuelingDQN
 from arguments import argparser
@@ -58,24 +58,107 @@ def check_connection(n_actors):
     return True
 
 
-def send_param(param_queue):
+def serve_param_requests(ctx, latest):
+    """
+    Reply to actors asking for parameters newer than their version.
+    Replies without arrays carry only the latest version, as do all of
+    them before the first publish.
+    """
+    socket = ctx.socket(zmq.ROUTER)
+    socket.bind("tcp://*:52003")
+    while True:
+        identity, null, *data = socket.recv_multipart(copy=False)
+        _, meta = wire.unpack(data)
+        # one load, so the version always comes with its own frames
+        version, frames = latest['message']
+        if frames is None or version <= meta['version']:
+            frames = wire.pack([], version=version)
+        socket.send_multipart([identity, null] + frames, copy=False)
+
+
+def send_param(param_queue, precision):
     ctx = zmq.Context()
     socket = ctx.socket(zmq.PUB)
     socket.set_hwm(3)
     socket.bind("tcp://*:52001")
+    latest = {'message': (-1, None)}
+    threading.Thread(target=serve_param_requests, args=(ctx, latest), daemon=True).start()
     while True:
-        param = param_queue.get()
-        for k, v in param.items():
-            param[k] = v.cpu()
-        data = pickle.dumps(param)
-        socket.send(data, copy=False)
-        param, data = None, None
+        version, param = param_queue.get()
+        frames = utils.encode_params(param, version, precision)
+        latest['message'] = (version, frames)
+        # one frame since subscribers CONFLATE
+        socket.send(wire.join(frames), copy=False)
+        param, frames = None, None
         print('Successfully publisehd parameters!')
 
 
-def recv_batch(batch_queue, replay_ip, device):
+class BatchSlots:
+    """
+    Fixed pool of preallocated batches in shared memory.
+    Receiver processes take a free slot, fill it in place and pass its index
+    to the training process, which releases the slot once it is done with
+    the batch. Receivers block while every slot is in use.
+    """
+    def __init__(self, n_slots, batch_size, observation_size):
+        shapes = [(observation_size, ), (), (), (observation_size, ), (), (), ()]
+        # columns of replay.BATCH_DTYPES
+        dtypes = [torch.float32, torch.int64, torch.float32, torch.float32,
+                  torch.float32, torch.float32, torch.int64]
+        self.tensors = [torch.zeros((n_slots, batch_size) + shape, dtype=dtype).share_memory_()
+                        for shape, dtype in zip(shapes, dtypes)]
+        self.free_queue = Queue(maxsize=n_slots)
+        self.full_queue = Queue(maxsize=n_slots)
+        for slot in range(n_slots):
+            self.free_queue.put(slot)
+
+    def pin_memory(self):
+        """
+        page-lock the slots so copies to the GPU can be asynchronous.
+        Only needed in the process that moves batches to the device.
+        """
+        if not torch.cuda.is_available():
+            return
+        cudart = torch.cuda.cudart()
+        for tensor in self.tensors:
+            cudart.cudaHostRegister(tensor.data_ptr(), tensor.numel() * tensor.element_size(), 0)
+
+    def put(self, arrays):
+        slot = self.free_queue.get()
+        for tensor, array in zip(self.tensors, arrays):
+            tensor[slot].numpy()[...] = array
+        self.full_queue.put(slot)
+
+    def get(self, device):
+        """
+        Returns the slot index, the batch on device and the idxes as numpy
+        """
+        slot = self.full_queue.get()
+        *tensors, idxes = self.tensors
+        batch = [tensor[slot].to(device, non_blocking=True) for tensor in tensors]
+        return slot, batch, idxes[slot].numpy().copy()
+
+    def get_many(self, n_batches, device):
+        """
+        Returns the indexes of n_batches slots, their batches concatenated
+        into one on device and their idxes as numpy
+        """
+        if n_batches == 1:
+            slot, batch, idxes = self.get(device)
+            return [slot], batch, idxes
+        taken = [self.full_queue.get() for _ in range(n_batches)]
+        index = torch.tensor(taken)
+        *tensors, idxes = [tensor.index_select(0, index).flatten(0, 1) for tensor in self.tensors]
+        batch = [tensor.to(device, non_blocking=True) for tensor in tensors]
+        return taken, batch, idxes.numpy()
+
+    def release(self, slot):
+        self.free_queue.put(slot)
+
+
+def recv_batch(slots, replay_ip):
     """
-    receive batch from replay and transfer batch from cpu to gpu
+    receive batch from replay and write it into a free shared-memory slot
     """
     def _thunk(thread_queue):
         ctx = zmq.Context.instance()
@@ -88,11 +171,11 @@ def recv_batch(batch_queue, replay_ip, device):
             outstanding += 1
             if outstanding < 3:
                 try:
-                    data = socket.recv(zmq.NOBLOCK, copy=False)
+                    data = socket.recv_multipart(zmq.NOBLOCK, copy=False)
                 except zmq.Again:
                     continue
             else:
-                data = socket.recv(copy=False)
+                data = socket.recv_multipart(copy=False)
             thread_queue.put(data)
             outstanding -= 1
             data = None
@@ -102,22 +185,10 @@ def recv_batch(batch_queue, replay_ip, device):
 
     while True:
         data = thread_queue.get()
-        batch = pickle.loads(data)
+        # replay sends collated arrays (see replay.collate_batch)
+        batch, _ = wire.unpack(data)
         print('Receiving batch from replays...')
-
-        states, actions, rewards, next_states, dones, weights, idxes = batch
-        states = np.array([np.array(state) for state in states])
-        print('states:', states.dtype)
-        states = torch.FloatTensor(states).to(device)
-        actions = torch.LongTensor(actions).to(device)
-        rewards = torch.FloatTensor(rewards).to(device)
-        next_states = np.array([np.array(state) for state in next_states])
-        next_states = torch.FloatTensor(next_states).to(device)
-        dones = torch.FloatTensor(dones).to(device)
-        weights = torch.FloatTensor(weights).to(device)
-
-        batch = [states, actions, rewards, next_states, dones, weights, idxes]
-        batch_queue.put(batch)
+        slots.put(batch)
         data, batch = None, None
 
 
@@ -133,12 +204,12 @@ def send_prios(prios_queue, replay_ip):
         while outstanding >= max_outstanding:
             socket.recv()
             outstanding -= 1
-        socket.send(pickle.dumps((idxes, prios)), copy=False)
+        socket.send_multipart(wire.pack([idxes, prios]), copy=False)
         outstanding += 1
         idxes, prios = None, None
 
 
-def train(args, n_actors, batch_queue, prios_queue, param_queue):
+def train(args, n_actors, slots, prios_queue, param_queue):
     env = RunTagEnv(width=5, height=5, number_of_subordinates=1, max_steps=1000)
     #env = wrapper.make_atari(args.env)
     #env = wrapper.wrap_atari_dqn(env, args)
@@ -150,37 +221,58 @@ def train(args, n_actors, batch_queue, prios_queue, param_queue):
 
     writer = SummaryWriter(comment="-{}-learner".format(args.env))
     # optimizer = torch.optim.Adam(model.parameters(), args.lr)
-    optimizer = torch.optim.RMSprop(model.parameters(), args.lr, alpha=0.95, eps=1.5e-7, centered=True)
+    optimizer = torch.optim.RMSprop(model.parameters(), args.lr, alpha=0.95, eps=1.5e-7, centered=True,
+                                    foreach=True)
 
+    slots.pin_memory()
     check_connection(n_actors)
 
-    param_queue.put(model.state_dict())
+    # priorities wait in prios_queue until send_prios takes them
+    prios_buffers = utils.PriorityBuffers(args.prios_queue_size + 1)
+
+    # parameter version is the number of updates behind them
+    param_queue.put((0, model.state_dict()))
     learn_idx = 0
+    # summed on the device and read once per bps_interval, not synced every step
+    loss_sum = torch.zeros((), device=args.device)
+    grad_norm_sum = torch.zeros((), device=args.device)
     ts = time.time()
     while True:
-        *batch, idxes = batch_queue.get()
-        loss, prios = utils.compute_loss(model, tgt_model, batch, args.n_steps, args.gamma)
+        taken, batch, idxes = slots.get_many(args.n_batches_per_step, args.device)
+        loss, prios = utils.compute_loss(model, tgt_model, batch, args.n_steps, args.gamma, prios_buffers)
         grad_norm = utils.update_parameters(loss, model, optimizer, args.max_norm)
+        # on CPU the batch tensors are the slot itself and backward still reads them
+        for slot in taken:
+            slots.release(slot)
         print('Updated parameters!')
         prios_queue.put((idxes, prios))
         batch, idxes, prios = None, None, None
         learn_idx += 1
-
-        writer.add_scalar("learner/loss", loss, learn_idx)
-        writer.add_scalar("learner/grad_norm", grad_norm, learn_idx)
-
-        if learn_idx % args.target_update_interval == 0:
+        loss_sum += loss.detach()
+        grad_norm_sum += grad_norm
+        loss, grad_norm = None, None
+
+        # intervals count batches: an update of n batches passes a multiple of
+        # interval when the batches done since the last multiple are fewer than n
+        n_batches = learn_idx * args.n_batches_per_step
+        if n_batches % args.target_update_interval < args.n_batches_per_step:
             print("Updating Target Network..")
             tgt_model.load_state_dict(model.state_dict())
-        if learn_idx % args.save_interval == 0:
+        if n_batches % args.save_interval < args.n_batches_per_step:
             print("Saving Model..")
             torch.save(model.state_dict(), "model.pth")
-        if learn_idx % args.publish_param_interval == 0:
-            param_queue.put(model.state_dict())
+        if n_batches % args.publish_param_interval < args.n_batches_per_step:
+            param_queue.put((learn_idx, model.state_dict()))
         if learn_idx % args.bps_interval == 0:
             bps = args.bps_interval / (time.time() - ts)
-            print("Step: {:8} / BPS: {:.2f}".format(learn_idx, bps))
+            sps = bps * args.n_batches_per_step * args.batch_size
+            print("Step: {:8} / BPS: {:.2f} / Samples/s: {:.1f}".format(learn_idx, bps, sps))
             writer.add_scalar("learner/BPS", bps, learn_idx)
+            writer.add_scalar("learner/samples_per_second", sps, learn_idx)
+            writer.add_scalar("learner/loss", loss_sum.item() / args.bps_interval, learn_idx)
+            writer.add_scalar("learner/grad_norm", grad_norm_sum.item() / args.bps_interval, learn_idx)
+            loss_sum.zero_()
+            grad_norm_sum.zero_()
             ts = time.time()
 
 
@@ -188,18 +280,23 @@ def main():
     n_actors, replay_ip = get_environ()
     args = argparser()
 
+    env = RunTagEnv(width=5, height=5, number_of_subordinates=1, max_steps=1000)
+    observation_size = spaces.utils.flatdim(env.commander_observation_space)
+
+    assert args.queue_size >= args.n_batches_per_step, 'an update takes n_batches_per_step slots'
+
     # TODO: Need to adjust the maxsize of prios, param queue
-    batch_queue = Queue(maxsize=args.queue_size)
+    slots = BatchSlots(args.queue_size, args.batch_size, observation_size)
     prios_queue = Queue(maxsize=args.prios_queue_size)
     param_queue = Queue(maxsize=3)
     procs = [
-        Process(target=train, args=(args, n_actors, batch_queue, prios_queue, param_queue)),
-        Process(target=send_param, args=(param_queue, )),
+        Process(target=train, args=(args, n_actors, slots, prios_queue, param_queue)),
+        Process(target=send_param, args=(param_queue, args.param_precision)),
         Process(target=send_prios, args=(prios_queue, replay_ip)),
     ]
 
     for _ in range(args.n_recv_batch_process):
-        p = Process(target=recv_batch, args=(batch_queue, replay_ip, args.device))
+        p = Process(target=recv_batch, args=(slots, replay_ip))
         procs.append(p)
     for p in procs:
         p.start()
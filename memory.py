@@ -2,13 +2,15 @@
 # https://github.com/openai/baselines/blob/master/baselines/deepq/replay_buffer.py
 
 import random
+import threading
 from collections import deque
+from contextlib import contextmanager
 import operator
 import numpy as np
 
 
 class SegmentTree(object):
-    def __init__(self, capacity, operation, neutral_element):
+    def __init__(self, capacity, operation, neutral_element, scalar_operation=None):
         """Build a Segment Tree data structure.
         https://en.wikipedia.org/wiki/Segment_tree
         Can be used as regular array, but with two
@@ -19,42 +21,37 @@ class SegmentTree(object):
                operation which reduces `operation` over
                a contiguous subsequence of items in the
                array.
+        Nodes are kept in one contiguous float64 array laid out as an
+        implicit binary heap (root at 1, leaves at [capacity, 2 * capacity)),
+        so batches of leaves can be written and searched with NumPy.
         Paramters
         ---------
         capacity: int
             Total size of the array - must be a power of two.
-        operation: lambda obj, obj -> obj
-            and operation for combining elements (eg. sum, max)
+        operation: np.ufunc
+            binary NumPy ufunc for combining elements (eg. np.add, np.minimum)
             must for a mathematical group together with the set of
             possible values for array elements.
         neutral_element: obj
             neutral element for the operation above. eg. float('-inf')
             for max and 0 for sum.
+        scalar_operation: lambda obj, obj -> obj
+            same operation on Python floats (eg. operator.add, min), used
+            when a single item is set. Defaults to `operation`.
         """
         assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be positive and a power of 2."
         self._capacity = capacity
-        self._value = [neutral_element for _ in range(2 * capacity)]
+        self._depth = capacity.bit_length() - 1
+        self._value = np.full(2 * capacity, neutral_element, dtype=np.float64)
         self._operation = operation
-
-    def _reduce_helper(self, start, end, node, node_start, node_end):
-        if start == node_start and end == node_end:
-            return self._value[node]
-        mid = (node_start + node_end) // 2
-        if end <= mid:
-            return self._reduce_helper(start, end, 2 * node, node_start, mid)
-        else:
-            if mid + 1 <= start:
-                return self._reduce_helper(start, end, 2 * node + 1, mid + 1, node_end)
-            else:
-                return self._operation(
-                    self._reduce_helper(start, mid, 2 * node, node_start, mid),
-                    self._reduce_helper(mid + 1, end, 2 * node + 1, mid + 1, node_end)
-                )
+        self._scalar_operation = scalar_operation or operation
+        self._neutral_element = neutral_element
 
     def reduce(self, start=0, end=None):
         """Returns result of applying `self.operation`
         to a contiguous subsequence of the array.
             self.operation(arr[start], operation(arr[start+1], operation(... arr[end])))
+        Reducing over the whole array is O(1) since the root holds it.
         Parameters
         ----------
         start: int
@@ -70,32 +67,106 @@ class SegmentTree(object):
             end = self._capacity
         if end < 0:
             end += self._capacity
+        if start == 0 and end == self._capacity:
+            return float(self._value[1])
+
+        # bottom-up walk over the half-open range [start, end)
+        result = self._neutral_element
+        start += self._capacity
+        end += self._capacity
+        item = self._value.item
+        while start < end:
+            if start & 1:
+                result = self._scalar_operation(result, item(start))
+                start += 1
+            if end & 1:
+                end -= 1
+                result = self._scalar_operation(result, item(end))
+            start //= 2
+            end //= 2
+        return result
+
+    def set(self, idxes, values):
+        """Set arr[idxes[i]] = values[i] for a whole batch of leaves and
+        recompute their ancestors one tree level at a time. All leaves are
+        written first, then every affected internal node is recomputed once
+        even if several leaves share it. If an index is repeated, the last
+        value wins as with sequential assignment.
+        Parameters
+        ----------
+        idxes: array_like of int
+            indexes of the leaves to update
+        values: array_like of float or float
+            new values for the leaves
+        """
+        idxes = np.asarray(idxes, dtype=np.int64)
+        if idxes.size == 0:
+            return
+        values = np.broadcast_to(np.asarray(values, dtype=np.float64), idxes.shape)
+        idxes, last = np.unique(idxes[::-1], return_index=True)
+        self._value[idxes + self._capacity] = values[::-1][last]
+
+        idxes += self._capacity
+        for _ in range(self._depth):
+            idxes //= 2
+            # idxes stay sorted, so shared parents are adjacent
+            idxes = idxes[np.concatenate(([True], idxes[1:] != idxes[:-1]))]
+            self._value[idxes] = self._operation(
+                self._value[2 * idxes],
+                self._value[2 * idxes + 1]
+            )
+
+    def set_range(self, start, values):
+        """Set arr[start:start + len(values)] = values. The ancestors of a
+        contiguous block of leaves are contiguous on every level, so they are
+        recomputed with slices instead of index arrays.
+        """
+        start = start + self._capacity
+        end = start + len(values)
+        if start == end:
+            return
+        self._value[start:end] = values
         end -= 1
-        return self._reduce_helper(start, end, 1, 0, self._capacity - 1)
+        for _ in range(self._depth):
+            start //= 2
+            end //= 2
+            self._value[start:end + 1] = self._operation(
+                self._value[2 * start:2 * end + 2:2],
+                self._value[2 * start + 1:2 * end + 2:2]
+            )
 
     def __setitem__(self, idx, val):
+        if not np.isscalar(idx):
+            self.set(idx, val)
+            return
         # index of the leaf
         idx += self._capacity
         self._value[idx] = val
         idx //= 2
+        item = self._value.item
         while idx >= 1:
-            self._value[idx] = self._operation(
-                self._value[2 * idx],
-                self._value[2 * idx + 1]
+            self._value[idx] = self._scalar_operation(
+                item(2 * idx),
+                item(2 * idx + 1)
             )
             idx //= 2
 
     def __getitem__(self, idx):
+        if not np.isscalar(idx):
+            idx = np.asarray(idx, dtype=np.int64)
+            assert np.all((0 <= idx) & (idx < self._capacity))
+            return self._value[self._capacity + idx]
         assert 0 <= idx < self._capacity
-        return self._value[self._capacity + idx]
+        return float(self._value[self._capacity + idx])
 
 
 class SumSegmentTree(SegmentTree):
     def __init__(self, capacity):
         super(SumSegmentTree, self).__init__(
             capacity=capacity,
-            operation=operator.add,
-            neutral_element=0.0
+            operation=np.add,
+            neutral_element=0.0,
+            scalar_operation=operator.add
         )
 
     def sum(self, start=0, end=None):
@@ -110,30 +181,36 @@ class SumSegmentTree(SegmentTree):
         probability efficiently.
         Parameters
         ----------
-        perfixsum: float
-            upperbound on the sum of array prefix
+        perfixsum: float or array_like of float
+            upperbound on the sum of array prefix. If an array is given,
+            all prefixsums descend the tree together.
         Returns
         -------
-        idx: int
-            highest index satisfying the prefixsum constraint
+        idx: int or np.array
+            highest index satisfying the prefixsum constraint, with one
+            entry per prefixsum if an array was given
         """
-        assert 0 <= prefixsum <= self.sum() + 1e-5
-        idx = 1
-        while idx < self._capacity:  # while non-leaf
-            if self._value[2 * idx] > prefixsum:
-                idx = 2 * idx
-            else:
-                prefixsum -= self._value[2 * idx]
-                idx = 2 * idx + 1
-        return idx - self._capacity
+        is_scalar = np.isscalar(prefixsum)
+        prefixsum = np.array(prefixsum, dtype=np.float64, ndmin=1)
+        assert np.all(0 <= prefixsum) and np.all(prefixsum <= self.sum() + 1e-5)
+        idx = np.ones(len(prefixsum), dtype=np.int64)
+        for _ in range(self._depth):  # while non-leaf
+            idx *= 2
+            left = self._value[idx]
+            go_right = left <= prefixsum
+            prefixsum -= np.where(go_right, left, 0.0)
+            idx += go_right
+        idx -= self._capacity
+        return int(idx[0]) if is_scalar else idx
 
 
 class MinSegmentTree(SegmentTree):
     def __init__(self, capacity):
         super(MinSegmentTree, self).__init__(
             capacity=capacity,
-            operation=min,
-            neutral_element=float('inf')
+            operation=np.minimum,
+            neutral_element=float('inf'),
+            scalar_operation=min
         )
 
     def min(self, start=0, end=None):
@@ -142,6 +219,15 @@ class MinSegmentTree(SegmentTree):
         return super(MinSegmentTree, self).reduce(start, end)
 
 
+def importance_weights(priorities, p_total, p_min, n, beta):
+    """Importance sampling weights of transitions sampled proportionally to
+    `priorities` out of `n` transitions whose priorities sum to `p_total`,
+    normalized by the weight of the least likely transition (`p_min`).
+    """
+    max_weight = (p_min / p_total * n) ** (-beta)
+    return (priorities / p_total * n) ** (-beta) / max_weight
+
+
 class ReplayBuffer(object):
     def __init__(self, size):
         """Create Replay buffer.
@@ -238,14 +324,25 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         self._it_min[idx] = self._max_priority ** self._alpha
 
     def _sample_proportional(self, batch_size):
-        res = []
-        p_total = self._it_sum.sum(0, len(self._storage) - 1)
+        # one stratified mass per segment, all descending the tree together
+        p_total = self._it_sum.sum()
         every_range_len = p_total / batch_size
-        for i in range(batch_size):
-            mass = random.random() * every_range_len + i * every_range_len
-            idx = self._it_sum.find_prefixsum_idx(mass)
-            res.append(idx)
-        return res
+        masses = (np.random.random_sample(batch_size) + np.arange(batch_size)) * every_range_len
+        idxes = self._it_sum.find_prefixsum_idx(masses)
+        return self._clip_sampled_idxes(idxes)
+
+    def _set_priorities(self, idxes, priorities):
+        priorities = np.asarray(priorities, dtype=np.float64)
+        if len(priorities) == 0:
+            return
+        priorities_alpha = priorities ** self._alpha
+        self._it_sum.set(idxes, priorities_alpha)
+        self._it_min.set(idxes, priorities_alpha)
+        self._max_priority = max(self._max_priority, priorities.max())
+
+    def _clip_sampled_idxes(self, idxes):
+        # rounding near p_total may step into the empty tail of the tree
+        return np.minimum(idxes, len(self) - 1)
 
     def sample(self, batch_size, beta):
         """Sample a batch of experiences.
@@ -283,18 +380,32 @@ class PrioritizedReplayBuffer(ReplayBuffer):
 
         idxes = self._sample_proportional(batch_size)
 
-        weights = []
-        p_min = self._it_min.min() / self._it_sum.sum()
-        max_weight = (p_min * len(self._storage)) ** (-beta)
-
-        for idx in idxes:
-            p_sample = self._it_sum[idx] / self._it_sum.sum()
-            weight = (p_sample * len(self._storage)) ** (-beta)
-            weights.append(weight / max_weight)
-        weights = np.array(weights)
+        p_total, p_min, n = self.priority_stats()
+        weights = importance_weights(self._it_sum[idxes], p_total, p_min, n, beta)
         encoded_sample = self._encode_sample(idxes)
         return tuple(list(encoded_sample) + [weights, idxes])
 
+    def sample_priorities(self, batch_size):
+        """Sample a batch of experiences like `sample` but return the
+        sampled priorities (to the power of alpha) instead of importance
+        weights, so weights can be computed over several buffers.
+        Returns
+        -------
+        obs_batch, act_batch, rew_batch, next_obs_batch, done_mask: np.array
+            See sample
+        priorities: np.array
+            priority ** alpha of each sampled transition
+        idxes: np.array
+            idexes in buffer of sampled experiences
+        """
+        idxes = self._sample_proportional(batch_size)
+        encoded_sample = self._encode_sample(idxes)
+        return tuple(list(encoded_sample) + [self._it_sum[idxes], idxes])
+
+    def priority_stats(self):
+        """Returns sum and min of priority ** alpha and number of transitions"""
+        return self._it_sum.sum(), self._it_min.min(), len(self)
+
     def update_priorities(self, idxes, priorities):
         """Update priorities of sampled transitions.
         sets priority of transition at index idxes[i] in buffer
@@ -309,13 +420,11 @@ class PrioritizedReplayBuffer(ReplayBuffer):
             variable `idxes`.
         """
         assert len(idxes) == len(priorities)
-        for idx, priority in zip(idxes, priorities):
-            assert priority > 0
-            assert 0 <= idx < len(self._storage)
-            self._it_sum[idx] = priority ** self._alpha
-            self._it_min[idx] = priority ** self._alpha
-
-            self._max_priority = max(self._max_priority, priority)
+        idxes = np.asarray(idxes, dtype=np.int64)
+        priorities = np.asarray(priorities, dtype=np.float64)
+        assert np.all(priorities > 0)
+        assert np.all((0 <= idxes) & (idxes < len(self)))
+        self._set_priorities(idxes, priorities)
 
 
 class CustomPrioritizedReplayBuffer(PrioritizedReplayBuffer):
@@ -343,6 +452,31 @@ class CustomPrioritizedReplayBuffer(PrioritizedReplayBuffer):
         self._it_min[idx] = priority ** self._alpha
         self._max_priority = max(self._max_priority, priority)
 
+    def add_batch(self, states, actions, rewards, next_states, dones, prios):
+        """Add a batch of transitions sent by an actor.
+        Storage is written per transition but both trees are updated once
+        for the whole batch.
+        """
+        idxes = []
+        for data in zip(states, actions, rewards, next_states, dones):
+            idxes.append(self._next_idx)
+            if self._next_idx >= len(self._storage):
+                self._storage.append(data)
+            else:
+                self._storage[self._next_idx] = data
+            self._next_idx = (self._next_idx + 1) % self._maxsize
+        self._set_priorities(idxes, prios)
+
+    def add_compact_batch(self, observations, next_index, actions, rewards, dones, prios):
+        """
+        Add a batch of transitions whose states are observations[:len(actions)]
+        and whose next states are observations[next_index], see compact_next_states.
+        """
+        observations = np.asarray(observations)
+        states = observations[:len(actions)]
+        next_states = observations[np.asarray(next_index)]
+        self.add_batch(states, actions, rewards, next_states, dones, prios)
+
     def _encode_sample(self, idxes):
         obses_t, actions, rewards, obses_tp1, dones = [], [], [], [], []
         for i in idxes:
@@ -360,6 +494,285 @@ class CustomPrioritizedReplayBuffer(PrioritizedReplayBuffer):
                 np.array(dones))
 
 
+class ArrayPrioritizedReplayBuffer(CustomPrioritizedReplayBuffer):
+    """
+    CustomPrioritizedReplayBuffer with columnar storage.
+    Transitions are written into fixed-dtype NumPy ring arrays allocated once,
+    instead of keeping a Python tuple (and its small objects) per transition.
+    add() becomes an index assignment per column and _encode_sample() is a
+    fancy-indexing gather which returns contiguous batch arrays.
+    """
+    def __init__(self, size, alpha, state_shape, state_dtype=np.float32):
+        super(ArrayPrioritizedReplayBuffer, self).__init__(size, alpha)
+        self._state_shape = tuple(state_shape)
+        self._states = np.zeros((size,) + self._state_shape, dtype=state_dtype)
+        self._actions = np.zeros(size, dtype=np.int64)
+        self._rewards = np.zeros(size, dtype=np.float32)
+        self._next_states = np.zeros((size,) + self._state_shape, dtype=state_dtype)
+        self._dones = np.zeros(size, dtype=np.float32)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def nbytes(self):
+        """Bytes held by the transition columns"""
+        return sum(column.nbytes for column in self._columns)
+
+    @property
+    def _columns(self):
+        return (self._states, self._actions, self._rewards, self._next_states, self._dones)
+
+    def add(self, state, action, reward, next_state, done, priority):
+        idx = self._next_idx
+        self._states[idx] = np.reshape(state, self._state_shape)
+        self._actions[idx] = action
+        self._rewards[idx] = reward
+        self._next_states[idx] = np.reshape(next_state, self._state_shape)
+        self._dones[idx] = done
+        self._size = min(self._size + 1, self._maxsize)
+        self._next_idx = (self._next_idx + 1) % self._maxsize
+
+        self._it_sum[idx] = priority ** self._alpha
+        self._it_min[idx] = priority ** self._alpha
+        self._max_priority = max(self._max_priority, priority)
+
+    def add_batch(self, states, actions, rewards, next_states, dones, prios):
+        """Add a batch of transitions sent by an actor.
+        The batch is written as one contiguous block of slots (two blocks if
+        it wraps around the end of the ring) and both trees are updated in
+        one batched pass.
+        """
+        n = len(actions)
+        assert n <= self._maxsize
+        states = np.reshape(np.asarray(states, dtype=self._states.dtype), (n, ) + self._state_shape)
+        next_states = np.reshape(np.asarray(next_states, dtype=self._next_states.dtype),
+                                 (n, ) + self._state_shape)
+        for ring, part in self._ring_slices(n):
+            self._states[ring] = states[part]
+            self._actions[ring] = actions[part]
+            self._rewards[ring] = rewards[part]
+            self._next_states[ring] = next_states[part]
+            self._dones[ring] = dones[part]
+
+        prios = np.asarray(prios, dtype=np.float64)
+        for ring, part in self._ring_slices(n):
+            self._it_sum.set_range(ring.start, prios[part] ** self._alpha)
+            self._it_min.set_range(ring.start, prios[part] ** self._alpha)
+        self._max_priority = max(self._max_priority, prios.max())
+        self._size = min(self._size + n, self._maxsize)
+        self._next_idx = (self._next_idx + n) % self._maxsize
+
+    def _ring_slices(self, n):
+        """Split n slots starting at _next_idx into (ring slice, batch slice) pairs"""
+        head = min(n, self._maxsize - self._next_idx)
+        slices = [(slice(self._next_idx, self._next_idx + head), slice(0, head))]
+        if head < n:
+            slices.append((slice(0, n - head), slice(head, n)))
+        return slices
+
+    def _encode_sample(self, idxes):
+        return tuple(column[idxes] for column in self._columns)
+
+
+class CompactPrioritizedReplayBuffer(ArrayPrioritizedReplayBuffer):
+    """
+    ArrayPrioritizedReplayBuffer which keeps every observation once.
+    The next state of an n-step transition is usually the state of the
+    transition n steps later in the same actor batch, so each row holds one
+    observation and refers to the row of its next state by a forward offset.
+    Next states which are not a state in their batch (the terminal state of an
+    episode, the last n transitions of a batch) are written as extra rows which
+    are only next states: they have zero priority and are never sampled.
+    Rows of one batch are written in order, so a row always outlives the
+    rows referring to it, also across ring buffer wraparound.
+    """
+    def __init__(self, size, alpha, state_shape, state_dtype=np.float32):
+        super(CompactPrioritizedReplayBuffer, self).__init__(size, alpha, state_shape, state_dtype)
+        self._next_states = None
+        self._next_offsets = np.zeros(size, dtype=np.int32)
+        self._valid = np.zeros(size, dtype=bool)
+        self._n_valid = 0
+
+    def __len__(self):
+        return self._n_valid
+
+    @property
+    def _columns(self):
+        return (self._states, self._actions, self._rewards, self._next_offsets, self._dones, self._valid)
+
+    def add(self, state, action, reward, next_state, done, priority):
+        self.add_compact_batch([state, next_state], [1], [action], [reward], [done], [priority])
+
+    def add_batch(self, states, actions, rewards, next_states, dones, prios):
+        observations, next_index = compact_next_states(states, next_states)
+        self.add_compact_batch(observations, next_index, actions, rewards, dones, prios)
+
+    def add_compact_batch(self, observations, next_index, actions, rewards, dones, prios):
+        """See CustomPrioritizedReplayBuffer.add_compact_batch"""
+        n_transitions, n_rows = len(actions), len(observations)
+        assert n_rows <= self._maxsize
+        next_offsets = np.asarray(next_index) - np.arange(n_transitions)
+        assert np.all((0 < next_offsets) & (next_offsets < n_rows))
+
+        observations = np.reshape(np.asarray(observations, dtype=self._states.dtype),
+                                  (n_rows, ) + self._state_shape)
+        is_transition = np.arange(n_rows) < n_transitions
+        prios = np.asarray(prios, dtype=np.float64)
+        # rows holding only a next state get the neutral element of each tree
+        sum_values = np.zeros(n_rows)
+        sum_values[:n_transitions] = prios ** self._alpha
+        min_values = np.where(is_transition, sum_values, float('inf'))
+        for ring, part in self._ring_slices(n_rows):
+            self._n_valid -= np.count_nonzero(self._valid[ring])
+            self._states[ring] = observations[part]
+            self._valid[ring] = is_transition[part]
+            self._it_sum.set_range(ring.start, sum_values[part])
+            self._it_min.set_range(ring.start, min_values[part])
+        self._n_valid += n_transitions
+        self._max_priority = max(self._max_priority, prios.max())
+
+        transitions = (self._next_idx + np.arange(n_transitions)) % self._maxsize
+        self._actions[transitions] = actions
+        self._rewards[transitions] = rewards
+        self._next_offsets[transitions] = next_offsets
+        self._dones[transitions] = dones
+        self._size = min(self._size + n_rows, self._maxsize)
+        self._next_idx = (self._next_idx + n_rows) % self._maxsize
+
+    def _clip_sampled_idxes(self, idxes):
+        # rounding may land on a zero-priority row, which directly follows
+        # the transitions of its batch
+        invalid = ~self._valid[idxes]
+        while np.any(invalid):
+            idxes[invalid] = (idxes[invalid] - 1) % self._maxsize
+            invalid = ~self._valid[idxes]
+        return idxes
+
+    def update_priorities(self, idxes, priorities):
+        """
+        See PrioritizedReplayBuffer.update_priorities. Rows which have been
+        overwritten by a next-state-only row since they were sampled are skipped.
+        """
+        assert len(idxes) == len(priorities)
+        idxes = np.asarray(idxes, dtype=np.int64)
+        priorities = np.asarray(priorities, dtype=np.float64)
+        assert np.all(priorities > 0)
+        assert np.all((0 <= idxes) & (idxes < self._maxsize))
+
+        keep = self._valid[idxes]
+        self._set_priorities(idxes[keep], priorities[keep])
+
+    def _encode_sample(self, idxes):
+        next_idxes = (idxes + self._next_offsets[idxes]) % self._maxsize
+        return (self._states[idxes],
+                self._actions[idxes],
+                self._rewards[idxes],
+                self._states[next_idxes],
+                self._dones[idxes])
+
+
+class ReadWriteLock:
+    """
+    Lock which admits many readers or a single writer.
+    Writers waiting for the lock block new readers, so a steady stream of
+    samples cannot starve inserts and priority updates.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class ConcurrentReplayBuffer:
+    """
+    Thread-safe view of a prioritized replay buffer.
+    Sampling only reads the trees and the storage, so any number of threads
+    sample concurrently and NumPy gathers overlap wherever they release the
+    GIL. Inserts and priority updates take the lock exclusively.
+    """
+    def __init__(self, buffer, lock=None):
+        self._buffer = buffer
+        self._lock = lock or ReadWriteLock()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def add_batch(self, *args, **kwargs):
+        with self._lock.write():
+            self._buffer.add_batch(*args, **kwargs)
+
+    def add_compact_batch(self, *args, **kwargs):
+        with self._lock.write():
+            self._buffer.add_compact_batch(*args, **kwargs)
+
+    def update_priorities(self, idxes, priorities):
+        with self._lock.write():
+            self._buffer.update_priorities(idxes, priorities)
+
+    def sample(self, batch_size, beta):
+        with self._lock.read():
+            return self._buffer.sample(batch_size, beta)
+
+
+def compact_next_states(states, next_states):
+    """
+    Store every observation of an actor batch once.
+    The next state of transition i is the state of transition i + n unless
+    the episode or the batch ended in between. Observations are matched by
+    identity, which holds for the objects kept by BatchStorage and which
+    pickle preserves within one message.
+    Returns
+    -------
+    observations: list
+        states followed by the next states which are not among them
+    next_index: np.array
+        next_states[i] is observations[next_index[i]]
+    """
+    observations = list(states)
+    position = {id(state): idx for idx, state in enumerate(states)}
+    next_index = np.empty(len(next_states), dtype=np.int64)
+    for i, next_state in enumerate(next_states):
+        idx = position.get(id(next_state))
+        if idx is None or idx <= i:
+            idx = len(observations)
+            observations.append(next_state)
+            position[id(next_state)] = idx
+        next_index[i] = idx
+    return observations, next_index
+
+
 class BatchStorage:
     """
     Storage for actors to support multi-step learning and efficient priority calculation.
@@ -383,7 +796,8 @@ class BatchStorage:
         self.gamma = gamma
 
     def add(self, state, reward, action, done, q_values):
-        if len(self.state_deque) == self.n_steps or done:
+        # an episode done on its first step leaves no transition to make
+        if self.state_deque and (len(self.state_deque) == self.n_steps or done):
             t0_state = self.state_deque[0]
             t0_reward = self.multi_step_reward(*self.reward_deque, reward)
             t0_action = self.action_deque[0]
@@ -400,15 +814,23 @@ class BatchStorage:
             self.next_q_values.append(tp_n_q_values)
 
         if done:
-            self.state_deque.clear()
-            self.reward_deque.clear()
-            self.action_deque.clear()
+            self.end_episode()
         else:
             self.state_deque.append(state)
             self.reward_deque.append(reward)
             self.action_deque.append(action)
             self.q_values_deque.append(q_values)
 
+    def end_episode(self):
+        """
+        Drop the steps still waiting for their n-step return, so transitions
+        never span two episodes. Transitions already made are kept
+        """
+        self.state_deque.clear()
+        self.reward_deque.clear()
+        self.action_deque.clear()
+        self.q_values_deque.clear()
+
     def reset(self):
         self.states = []
         self.actions = []
@@ -439,6 +861,20 @@ class BatchStorage:
         batch = [self.states, self.actions, self.rewards, self.next_states, self.dones]
         return batch, prios
 
+    def make_compact_batch(self):
+        """
+        Same transitions as make_batch as arrays, with observations shared
+        between states and next states (see compact_next_states)
+        """
+        prios = self.compute_priorities()
+        observations, next_index = compact_next_states(self.states, self.next_states)
+        batch = [np.stack(observations),
+                 next_index,
+                 np.array(self.actions, dtype=np.int64),
+                 np.array(self.rewards, dtype=np.float32),
+                 np.array(self.dones, dtype=np.float32)]
+        return batch, prios
+
     def multi_step_reward(self, *rewards):
         ret = 0.
         for idx, reward in enumerate(rewards):
@@ -2,6 +2,8 @@
 Module for DQN Model in Ape-X.
 """
 import random
+
+import numpy as np
 import torch
 import torch.nn as nn
 from gym import spaces
@@ -45,6 +47,9 @@ class RandomPolicy():
         action = random.randrange(self.num_actions)
         return action
 
+    def act_batch(self, states, epsilons):
+        return np.random.randint(self.num_actions, size=len(states))
+
 
 class DuelingDQN(nn.Module):
     """
@@ -74,30 +79,123 @@ class DuelingDQN(nn.Module):
         )
 
     def forward(self, x):
+        """
+        Return q values of a (N, observation_size) batch of states, with the
+        advantages of every state centred over its actions
+        """
         advantage = self.advantage(x)
         value = self.value(x)
-        return value + advantage - advantage.mean(0, keepdim=True)
+        return value + advantage - advantage.mean(-1, keepdim=True)
 
     def _feature_size(self):
         return self.features(torch.zeros(1, *self.input_shape)).view(1, -1).size(1)
 
     def act(self, state, epsilon):
         """
-        Return action, max_q_value for given state
+        Return action, q_values for a single state, as act_batch on a batch of one
+        """
+        actions, q_values = self.act_batch(torch.as_tensor(state).reshape(1, -1), [epsilon])
+        return int(actions[0]), q_values[0]
+
+    def act_batch(self, states, epsilons):
+        """
+        Return actions, q_values for a (N, observation_size) batch of states,
+        each acting epsilon-greedily with its own epsilon
         """
         with torch.no_grad():
-            state = state.squeeze(0)
-            q_values = self.forward(state)
-            #print('q values:', q_values)
-            #print('q values shape:', q_values.shape)
-
-            if random.random() > epsilon:
-                #print('q_max:', q_values.max(0))
-                #print('action:', q_values.max(0)[1].item())
-                action = q_values.max(0)[1].item()
-            else:
-                action = random.randrange(self.num_actions)
-        return action, q_values.numpy()
+            q_values = self.forward(torch.as_tensor(states)).numpy()
+        return epsilon_greedy(q_values, epsilons, self.num_actions), q_values
+
+
+class TracedDuelingDQN():
+    """
+    DuelingDQN.act and act_batch through a TorchScript trace of its forward,
+    which skips the Python of nn.Module calls. save exports the trace,
+    loadable without this module by torch.jit.load
+    """
+    def __init__(self, model):
+        self.num_actions = model.num_actions
+        self.module = torch.jit.trace(model, torch.zeros(1, model.observation_size))
+
+    def load_state_dict(self, state_dict):
+        self.module.load_state_dict(state_dict)
+
+    def save(self, path):
+        self.module.save(path)
+
+    def act(self, state, epsilon):
+        actions, q_values = self.act_batch(torch.as_tensor(state).reshape(1, -1), [epsilon])
+        return int(actions[0]), q_values[0]
+
+    def act_batch(self, states, epsilons):
+        with torch.inference_mode():
+            q_values = self.module(torch.as_tensor(states)).numpy()
+        return epsilon_greedy(q_values, epsilons, self.num_actions), q_values
+
+
+class NumpyDuelingDQN():
+    """
+    DuelingDQN.act and act_batch in NumPy, with weights cached as arrays by
+    load_state_dict. The hidden layers of both heads run as one matmul and
+    their output layers as another, through a block-diagonal weight
+    """
+    def __init__(self, model):
+        self.num_actions = model.num_actions
+        self.load_state_dict(model.state_dict())
+
+    def load_state_dict(self, state_dict):
+        arrays = {name: tensor.detach().cpu().numpy().astype(np.float32) for name, tensor in state_dict.items()}
+        self.hidden_weight = np.concatenate([arrays['advantage.0.weight'], arrays['value.0.weight']]).T.copy()
+        self.hidden_bias = np.concatenate([arrays['advantage.0.bias'], arrays['value.0.bias']])
+        hidden_size = len(arrays['advantage.0.bias'])
+        # columns are the advantages then the value
+        self.output_weight = np.zeros((2 * hidden_size, self.num_actions + 1), dtype=np.float32)
+        self.output_weight[:hidden_size, :-1] = arrays['advantage.2.weight'].T
+        self.output_weight[hidden_size:, -1:] = arrays['value.2.weight'].T
+        self.output_bias = np.concatenate([arrays['advantage.2.bias'], arrays['value.2.bias']])
+
+    def forward(self, states):
+        hidden = np.asarray(states, dtype=np.float32) @ self.hidden_weight
+        hidden += self.hidden_bias
+        np.maximum(hidden, 0., out=hidden)
+        output = hidden @ self.output_weight
+        output += self.output_bias
+        advantage, value = output[:, :-1], output[:, -1:]
+        return value + advantage - advantage.mean(1, keepdims=True)
+
+    def act(self, state, epsilon):
+        actions, q_values = self.act_batch(np.asarray(state, dtype=np.float32).reshape(1, -1), [epsilon])
+        return int(actions[0]), q_values[0]
+
+    def act_batch(self, states, epsilons):
+        q_values = self.forward(states)
+        return epsilon_greedy(q_values, epsilons, self.num_actions), q_values
+
+
+INFERENCE_BACKENDS = {
+    'eager': lambda model: model,
+    'traced': TracedDuelingDQN,
+    'numpy': NumpyDuelingDQN,
+}
+
+
+def inference_model(model, backend='eager'):
+    """
+    Return model itself for eager, or a TracedDuelingDQN or NumpyDuelingDQN
+    following it. All of them take load_state_dict, act and act_batch
+    """
+    return INFERENCE_BACKENDS[backend](model)
+
+
+def epsilon_greedy(q_values, epsilons, num_actions):
+    """
+    Return the greedy actions of a (K, num_actions) array of q values, each
+    replaced by a random action with its own probability in epsilons
+    """
+    actions = q_values.argmax(1)
+    explore = np.random.random_sample(len(actions)) < epsilons
+    actions[explore] = np.random.randint(num_actions, size=int(explore.sum()))
+    return actions
 
 
 class Flatten(nn.Module):
@@ -8,41 +8,64 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Process
 
+import numpy as np
 import zmq
 from zmq.asyncio import Context
+from gym import spaces
 
 import utils
-from memory import CustomPrioritizedReplayBuffer
+import wire
+from memory import CustomPrioritizedReplayBuffer, ArrayPrioritizedReplayBuffer, CompactPrioritizedReplayBuffer
+from memory import ConcurrentReplayBuffer, importance_weights
 from arguments import argparser
 
+from runtag.envs.centralized import RunTagEnv
 
-def push_batch(buffer, data):
+
+def push_batch(buffer, frames):
     """
-    support function to push batch samples to buffer
+    support function to push batch samples to buffer.
+    Returns the parameter version the actor generated the batch with.
     """
-    batch, prios = pickle.loads(data)
-    for sample in zip(*batch, prios):
-        buffer.add(*sample)
+    batch, meta = wire.unpack(frames)
+    *batch, prios = batch
+    buffer.add_compact_batch(*batch, prios)
     batch, prios = None, None
+    return meta.get('param_version', -1)
 
 
-def update_prios(buffer, data):
+def update_prios(buffer, frames):
     """
     support function to update priorities to buffer
     """
-    idxes, prios = pickle.loads(data)
+    (idxes, prios), _ = wire.unpack(frames)
     buffer.update_priorities(idxes, prios)
     idxes, prios = None, None
 
 
+# dtypes of states, actions, rewards, next_states, dones, weights, idxes
+BATCH_DTYPES = (np.float32, np.int64, np.float32, np.float32, np.float32, np.float32, np.int64)
+
+
+def collate_batch(batch):
+    """
+    convert a sampled batch to contiguous arrays the learner can wrap as
+    tensors directly, with states flattened to (batch_size, observation size)
+    """
+    batch = [np.ascontiguousarray(column, dtype=dtype) for column, dtype in zip(batch, BATCH_DTYPES)]
+    for i in (0, 3):
+        batch[i] = batch[i].reshape(len(batch[i]), -1)
+    return batch
+
+
 def sample_batch(buffer, batch_size, beta):
     """
-    support function to update priorities to buffer
+    support function to sample batch from buffer as message frames
     """
-    batch = buffer.sample(batch_size, beta)
-    data = pickle.dumps(batch)
+    batch = collate_batch(buffer.sample(batch_size, beta))
+    frames = wire.pack(batch)
     batch = None
-    return data
+    return frames
 
 
 def recv_batch_device():
@@ -74,7 +97,7 @@ def send_batch_device():
     zmq.proxy(frontend, backend)
 
 
-async def recv_batch_worker(buffer, exe, event, lock, threshold_size):
+async def recv_batch_worker(buffer, exe, event, threshold_size):
     """
     coroutine to receive batch from actors
     """
@@ -86,20 +109,23 @@ async def recv_batch_worker(buffer, exe, event, lock, threshold_size):
     start = False
     cnt = 0
     ts = time.time()
+    # range of parameter versions behind the batches since the last log
+    versions = [np.inf, -np.inf]
 
     while True:
-        identity, data = await socket.recv_multipart(copy=False)
-        async with lock:
-            await loop.run_in_executor(exe, push_batch, buffer, data)
+        identity, *data = await socket.recv_multipart(copy=False)
+        version = await loop.run_in_executor(exe, push_batch, buffer, data)
         await socket.send_multipart((identity, b''))
         # TODO: 1. Only one worker should print log to console.
         #       2. Hard-coded part in (50 * cnt * 4) should be fixed.
         data = None
         cnt += 1
+        versions = [min(versions[0], version), max(versions[1], version)]
         if cnt % 100 == 0:
-            print("Buffer Size: {} / FPS: {:.2f}".format(
-                len(buffer), (50 * cnt * 4) / (time.time() - ts)
+            print("Buffer Size: {} / FPS: {:.2f} / Param versions: [{}, {}]".format(
+                len(buffer), (50 * cnt * 4) / (time.time() - ts), *versions
             ))
+            versions = [np.inf, -np.inf]
             ts = time.time()
             if not start and len(buffer) >= threshold_size:
                 start = True
@@ -107,7 +133,7 @@ async def recv_batch_worker(buffer, exe, event, lock, threshold_size):
     return True
 
 
-async def recv_prios_worker(buffer, exe, event, lock):
+async def recv_prios_worker(buffer, exe, event):
     """
     coroutine to receive priorities from learner
     """
@@ -117,16 +143,15 @@ async def recv_prios_worker(buffer, exe, event, lock):
     socket.connect("ipc:///tmp/5102.ipc")
     await event.wait()
     while True:
-        identity, data = await socket.recv_multipart(copy=False)
+        identity, *data = await socket.recv_multipart(copy=False)
         print('Replay: Received prios!')
-        async with lock:
-            await loop.run_in_executor(exe, update_prios, buffer, data)
+        await loop.run_in_executor(exe, update_prios, buffer, data)
         await socket.send_multipart((identity, b''))
         data = None
     return True
 
 
-async def send_batch_worker(buffer, exe, event, lock, batch_size, beta):
+async def send_batch_worker(buffer, exe, event, batch_size, beta):
     """
     coroutine to send training batches to learner
     """
@@ -139,15 +164,210 @@ async def send_batch_worker(buffer, exe, event, lock, batch_size, beta):
     await event.wait()
     while True:
         identity, _ = await socket.recv_multipart(copy=False)
-        # TODO: Is there any other greay way to support lock but make sampling faster?
-        async with lock:
-            batch = await loop.run_in_executor(exe, sample_batch, buffer, batch_size, beta)
+        batch = await loop.run_in_executor(exe, sample_batch, buffer, batch_size, beta)
         print('Replay: Sending batch...')
-        await socket.send_multipart([identity, batch], copy=False)
+        await socket.send_multipart([identity] + batch, copy=False)
         batch = None
     return True
 
 
+def make_buffer(args, size=None):
+    """
+    build the replay buffer selected by --replay_storage
+    """
+    size = size or args.replay_buffer_size
+    if args.replay_storage == 'tuple':
+        return CustomPrioritizedReplayBuffer(size, args.alpha)
+    env = RunTagEnv(width=5, height=5, number_of_subordinates=1, max_steps=1000)
+    state_shape = (spaces.utils.flatdim(env.commander_observation_space), )
+    if args.replay_storage == 'compact':
+        buffer = CompactPrioritizedReplayBuffer(size, args.alpha, state_shape)
+    else:
+        buffer = ArrayPrioritizedReplayBuffer(size, args.alpha, state_shape)
+    print("Replay storage: {:.1f} MB".format(buffer.nbytes / 2 ** 20))
+    return buffer
+
+
+def shard_address(shard_id):
+    return "ipc:///tmp/5104-{}.ipc".format(shard_id)
+
+
+def replay_shard(args, shard_id):
+    """
+    process owning one shard of the replay buffer and its sum tree.
+    Commands from the coordinator are served one at a time, so the shard
+    needs no lock. Every reply carries the priority stats of the shard.
+    """
+    utils.set_global_seeds(args.seed + shard_id, use_torch=False)
+    buffer = make_buffer(args, args.replay_buffer_size // args.n_replay_shards)
+    ctx = zmq.Context()
+    socket = ctx.socket(zmq.ROUTER)
+    socket.bind(shard_address(shard_id))
+    while True:
+        identity, command, *data = socket.recv_multipart(copy=False)
+        command, reply = command.bytes, []
+        if command == b'push':
+            push_batch(buffer, data)
+        elif command == b'prios':
+            update_prios(buffer, data)
+        elif command == b'sample':
+            _, meta = wire.unpack(data)
+            reply = buffer.sample_priorities(meta['batch_size'])
+        stats = [float(stat) for stat in buffer.priority_stats()]
+        socket.send_multipart([identity] + wire.pack(reply, stats=stats), copy=False)
+        data, reply = None, None
+
+
+class ShardClient:
+    """
+    coordinator-side connection of one worker coroutine to all replay shards.
+    Global buffer indexes are shard_id * shard_size + index in the shard.
+    `stats` holds (sum, min, count) of every shard as of its latest reply
+    and is shared by all clients.
+    """
+    def __init__(self, stats, shard_size):
+        self.stats = stats
+        self.shard_size = shard_size
+        ctx = Context.instance()
+        self.sockets = []
+        for shard_id in range(len(stats)):
+            socket = ctx.socket(zmq.DEALER)
+            socket.connect(shard_address(shard_id))
+            self.sockets.append(socket)
+
+    def __len__(self):
+        return int(self.stats[:, 2].sum())
+
+    async def request(self, shard_id, command, frames):
+        socket = self.sockets[shard_id]
+        await socket.send_multipart([command] + frames, copy=False)
+        reply, meta = wire.unpack(await socket.recv_multipart(copy=False))
+        self.stats[shard_id] = meta['stats']
+        return reply
+
+    async def push_batch(self, identity, frames):
+        # actors keep to one shard, chosen by actor id; frames are forwarded as received
+        actor_id = int(pickle.loads(identity).rsplit('-', 1)[-1])
+        await self.request(actor_id % len(self.sockets), b'push', frames)
+
+    async def update_prios(self, frames):
+        (idxes, prios), _ = wire.unpack(frames)
+        shard_ids = idxes // self.shard_size
+        requests = []
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            frames = wire.pack([idxes[mask] - shard_id * self.shard_size, prios[mask]])
+            requests.append(self.request(int(shard_id), b'prios', frames))
+        await asyncio.gather(*requests)
+
+    async def sample_batch(self, batch_size, beta):
+        # draw how many samples each shard contributes by its share of the
+        # total priority, then weight the merged batch over all shards
+        totals = self.stats[:, 0]
+        counts = np.random.multinomial(batch_size, totals / totals.sum())
+        shard_ids = np.flatnonzero(counts)
+        replies = await asyncio.gather(*[
+            self.request(int(shard_id), b'sample', wire.pack([], batch_size=int(counts[shard_id])))
+            for shard_id in shard_ids
+        ])
+        samples = []
+        for shard_id, reply in zip(shard_ids, replies):
+            *encoded, priorities, idxes = reply
+            samples.append(encoded + [priorities, idxes + shard_id * self.shard_size])
+        *encoded, priorities, idxes = [np.concatenate(column) for column in zip(*samples)]
+
+        p_total, p_min, n = self.stats[:, 0].sum(), self.stats[:, 1].min(), self.stats[:, 2].sum()
+        weights = importance_weights(priorities, p_total, p_min, n, beta)
+        return wire.pack(collate_batch(encoded + [weights, idxes]))
+
+
+async def sharded_recv_batch_worker(client, event, threshold_size):
+    """
+    coroutine to forward batches from actors to their shard
+    """
+    ctx = Context.instance()
+    socket = ctx.socket(zmq.DEALER)
+    socket.connect("ipc:///tmp/5101.ipc")
+    cnt = 0
+    ts = time.time()
+    versions = [np.inf, -np.inf]
+    while True:
+        identity, *data = await socket.recv_multipart(copy=False)
+        version = wire.unpack(data)[1].get('param_version', -1)
+        await client.push_batch(identity.bytes, data)
+        await socket.send_multipart((identity, b''))
+        data = None
+        cnt += 1
+        versions = [min(versions[0], version), max(versions[1], version)]
+        if cnt % 100 == 0:
+            print("Buffer Size: {} / Shards: {} / Pushes/s: {:.2f} / Param versions: [{}, {}]".format(
+                len(client), client.stats[:, 2].astype(int).tolist(), cnt / (time.time() - ts), *versions
+            ))
+            cnt, ts = 0, time.time()
+            versions = [np.inf, -np.inf]
+        if not event.is_set() and len(client) >= threshold_size:
+            event.set()
+
+
+async def sharded_recv_prios_worker(client, event):
+    """
+    coroutine to route priorities from learner to the owning shards
+    """
+    ctx = Context.instance()
+    socket = ctx.socket(zmq.DEALER)
+    socket.connect("ipc:///tmp/5102.ipc")
+    await event.wait()
+    while True:
+        identity, *data = await socket.recv_multipart(copy=False)
+        await client.update_prios(data)
+        await socket.send_multipart((identity, b''))
+        data = None
+
+
+async def sharded_send_batch_worker(client, event, batch_size, beta):
+    """
+    coroutine to send training batches merged from all shards to learner
+    """
+    ctx = Context.instance()
+    socket = ctx.socket(zmq.DEALER)
+    socket.connect("ipc:///tmp/5103.ipc")
+    await event.wait()
+    while True:
+        identity, _ = await socket.recv_multipart(copy=False)
+        batch = await client.sample_batch(batch_size, beta)
+        await socket.send_multipart([identity] + batch, copy=False)
+        batch = None
+
+
+async def sharded_main(args):
+    """
+    replay server whose buffer is split over --n_replay_shards processes.
+    This process only routes messages, so buffer work is spread over one
+    GIL per shard.
+    """
+    assert args.replay_storage != 'tuple', "sharded replay needs array storage"
+    procs = [Process(target=replay_shard, args=(args, shard_id))
+             for shard_id in range(args.n_replay_shards)]
+    for p in procs:
+        p.start()
+
+    stats = np.zeros((args.n_replay_shards, 3))
+    stats[:, 1] = np.inf
+    shard_size = args.replay_buffer_size // args.n_replay_shards
+    event = asyncio.Event()
+
+    workers = []
+    for _ in range(args.n_recv_batch_worker):
+        workers.append(sharded_recv_batch_worker(ShardClient(stats, shard_size), event, args.threshold_size))
+    for _ in range(args.n_recv_prios_worker):
+        workers.append(sharded_recv_prios_worker(ShardClient(stats, shard_size), event))
+    for _ in range(args.n_send_batch_worker):
+        workers.append(sharded_send_batch_worker(ShardClient(stats, shard_size), event,
+                                                 args.batch_size, args.beta))
+    await asyncio.gather(*workers)
+    return True
+
+
 async def main():
     """
     main event loop
@@ -163,21 +383,25 @@ async def main():
     for p in procs:
         p.start()
 
-    buffer = CustomPrioritizedReplayBuffer(args.replay_buffer_size, args.alpha)
+    if args.n_replay_shards > 1:
+        return await sharded_main(args)
+
+    # the buffer locks internally: samples run concurrently in the executor
+    # threads, inserts and priority updates are exclusive
+    buffer = ConcurrentReplayBuffer(make_buffer(args))
     exe = ThreadPoolExecutor()
     event = asyncio.Event()
-    lock = asyncio.Lock()
 
     # TODO: How to decide the proper number of asyncio workers?
     workers = []
     for _ in range(args.n_recv_batch_worker):
-        w = recv_batch_worker(buffer, exe, event, lock, args.threshold_size)
+        w = recv_batch_worker(buffer, exe, event, args.threshold_size)
         workers.append(w)
     for _ in range(args.n_recv_prios_worker):
-        w = recv_prios_worker(buffer, exe, event, lock)
+        w = recv_prios_worker(buffer, exe, event)
         workers.append(w)
     for _ in range(args.n_send_batch_worker):
-        w = send_batch_worker(buffer, exe, event, lock, args.batch_size, args.beta)
+        w = send_batch_worker(buffer, exe, event, args.batch_size, args.beta)
         workers.append(w)
 
     await asyncio.gather(*workers)
@@ -51,4 +51,6 @@ class RunTag(BaseRunTag):
                     input(f'{camp}.subordinate#{subordinate.identifier} receives to move {direction}')
                 elif (self.steps % 2)== 1:
                     input(f'{camp}.subordinate#{subordinate.identifier} moves {subordinate.direction}')
-                    SubordinateMove(subordinate.direction).act(subordinate)
\ No newline at end of file
+                    SubordinateMove(subordinate.direction).act(subordinate)
+
+        self.game.tick()
\ No newline at end of file
@@ -78,6 +78,10 @@ class RunTag(BaseRunTag):
             await self.tick()
             self.steps += 1
 
+            # a step of the game is one action of every soldier
+            if (self.steps % len(self.game.soldiers)) == 0:
+                self.game.tick()
+
     async def tick(self):
         identity = await self.socket.recv()
         message = await self.socket.recv_pyobj()
@@ -1,5 +1,4 @@
 from .equipments import Compass, Radio, Telescope
-from .station import Message, Station
 from .types import Entity
 
 
@@ -58,10 +57,7 @@ class Commander(Soldier):
 
     @property
     def tagged(self):
-        for soldier in self.alongside:
-            if self.is_enemy(soldier) and (soldier.rank == 'subordinate'):
-                return True
-        return False
+        return self.grid.enemies_with(self, 'subordinate') > 0
 
 class Subordinate(Soldier):
     rank = 'subordinate'
@@ -82,16 +78,14 @@ class Subordinate(Soldier):
 
     @property
     def taggable(self):
-        for soldier in self.alongside:
-            if self.is_enemy(soldier) and (soldier.rank == 'commander'):
-                return True
-        return False
+        return self.grid.enemies_with(self, 'commander') > 0
 
 
 class Squad(Entity):
     def __init__(self, grid, name):
         super().__init__(grid)
         self.name = name
+        self.station = None
         self.commander = None
         self.subordinates = []
 
@@ -3,11 +3,9 @@ import numpy as np
 from gym import spaces
 from gym.utils import seeding
 from runtag.actions import *
-from runtag.entities import Commander, Subordinate
+from runtag.entities import Subordinate
 from runtag.game import Game
 from runtag.renderer import TextRenderer
-from runtag.station import Station
-from runtag.utils import l1_distance
 
 
 class RunTagEnv(gym.Env):
@@ -43,6 +41,9 @@ class RunTagEnv(gym.Env):
             'identifier': spaces.Discrete(number_of_subordinates),
             'direction': spaces.Discrete(len(self.directions)),
         })
+        self.commander_observation_offsets = flat_offsets(self.commander_observation_space)
+        self.subordinate_observation_offsets = flat_offsets(self.subordinate_observation_space)
+        self._observation_rows = None
 
         self.seed()
 
@@ -52,6 +53,13 @@ class RunTagEnv(gym.Env):
 
         self.renderer = TextRenderer(self.game)
         self.steps = 0
+        # every agent is rewarded by its distance to enemies of the other rank
+        self._reward_targets = []
+        for squad in self.game.camps.values():
+            for soldier in squad.soldiers:
+                index = self.grid.index_of(soldier)
+                other_rank = 'subordinate' if soldier.rank == 'commander' else 'commander'
+                self._reward_targets.append((index, self.grid.enemy_indexes(index, other_rank)))
 
         return self.get_observations()
 
@@ -78,6 +86,7 @@ class RunTagEnv(gym.Env):
                 index = index_of_camp * self.number_of_agents_per_camp + index_of_subordinate + 1
                 self.subordinate_action_of(actions[index]).act(subordinate)
 
+        self.game.tick()
         self.steps += 1
         return [
             self.get_observations(),
@@ -91,30 +100,40 @@ class RunTagEnv(gym.Env):
         return [seed]
 
     def calculate_rewards(self):
-        rewards = []
-
-        for squad in self.game.camps.values():
-            commander = squad.commander
-            rewards.append(self.calculate_commander_reward(squad.commander))
-
-            for subordinate in squad.subordinates:
-                rewards.append(self.calculate_subordinate_reward(subordinate))
-
-        return rewards
-
-    def calculate_commander_reward(self, commander):
-        return -sum(l1_distance(self.grid.position_of(commander),
-                                self.grid.position_of(entity))
-                    for entity in self.game.entities(Subordinate)
-                    if commander.is_enemy(entity))
-
-    def calculate_subordinate_reward(self, subordinate):
-        return -sum(l1_distance(self.grid.position_of(subordinate),
-                                self.grid.position_of(entity))
-                    for entity in self.game.entities(Commander)
-                    if subordinate.is_enemy(entity))
+        """
+        Reward of every agent, minus the sum of its L1 distances to the
+        enemies of the other rank: subordinates for a commander and
+        commanders for a subordinate
+        """
+        xs, ys = self.grid.xs, self.grid.ys
+        return [-sum([abs(xs[index] - xs[other]) + abs(ys[index] - ys[other]) for other in targets])
+                for index, targets in self._reward_targets]
+
+    def set_observation_buffers(self, commanders, subordinates=None):
+        """
+        Write observations flattened as by spaces.utils.flatten into buffers
+        of the caller instead of building dicts of fresh arrays.
+        commanders is a (camps, flatdim) float32 array and subordinates an
+        optional (camps * number_of_subordinates, flatdim) float32 array,
+        without which subordinate observations stay dicts. reset and step
+        then return rows of the buffers, overwritten on the next call.
+        commanders=None goes back to dicts.
+        """
+        if commanders is None:
+            self._observation_rows = None
+            return
+
+        self._observation_rows = []
+        for camp in range(len(self.camps)):
+            self._observation_rows.append(commanders[camp])
+            for identifier in range(self.number_of_subordinates):
+                self._observation_rows.append(None if subordinates is None
+                                              else subordinates[camp * self.number_of_subordinates + identifier])
 
     def get_observations(self):
+        if self._observation_rows is not None:
+            return self.write_observations()
+
         observations = []
 
         for squad in self.game.camps.values():
@@ -148,6 +167,58 @@ class RunTagEnv(gym.Env):
             'subordinates': subordinates,
         }
 
+    def write_observations(self):
+        rows = iter(self._observation_rows)
+        observations = []
+
+        for squad in self.game.camps.values():
+            observations.append(self.write_commander_observation(squad.commander, next(rows)))
+
+            for subordinate in squad.subordinates:
+                row = next(rows)
+                if row is None:
+                    observations.append(self.get_subordinate_observation(subordinate))
+                else:
+                    observations.append(self.write_subordinate_observation(subordinate, row))
+
+        return observations
+
+    def write_commander_observation(self, commander, out):
+        """
+        get_commander_observation flattened into out
+        """
+        offsets = self.commander_observation_offsets
+        x, y = commander.position if commander.position is not None else (0, 0)
+        out[:] = 0
+        out[offsets['squad'] + self.camps.index(commander.squad.name)] = 1
+        out[offsets['position'] + x] = 1
+        out[offsets['position'] + self.width + y] = 1
+
+        if commander.observation is not None:
+            for (x, y), entities in commander.observation.items():
+                for entity in entities:
+                    if entity.rank == 'commander':
+                        out[offsets['commanders'] + y * self.width + x] = +1 if commander.is_friendly(entity) else -1
+                    elif entity.rank == 'subordinate':
+                        out[offsets['subordinates'] + y * self.width + x] = +1 if commander.is_friendly(entity) else -1
+
+        return out
+
+    def write_subordinate_observation(self, subordinate, out):
+        """
+        get_subordinate_observation flattened into out
+        """
+        offsets = self.subordinate_observation_offsets
+        direction = 0
+        if subordinate.direction is not None:
+            direction = self.directions.index(subordinate.direction)
+
+        out[:] = 0
+        out[offsets['squad'] + self.camps.index(subordinate.squad.name)] = 1
+        out[offsets['identifier'] + subordinate.identifier] = 1
+        out[offsets['direction'] + direction] = 1
+        return out
+
     def get_subordinate_observation(self, subordinate):
         direction = 0
         if subordinate.direction is not None:
@@ -197,3 +268,14 @@ class RunTagEnv(gym.Env):
             return 0
         elif isinstance(action, SubordinateMove):
             return 1 + cls.directions.index(action.direction)
+
+
+def flat_offsets(space):
+    """
+    Offset of every key of a Dict space in the layout of spaces.utils.flatten
+    """
+    offsets, offset = {}, 0
+    for key, subspace in space.spaces.items():
+        offsets[key] = offset
+        offset += spaces.utils.flatdim(subspace)
+    return offsets
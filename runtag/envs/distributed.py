@@ -6,7 +6,7 @@ import zmq
 from gym import spaces
 from gym.utils import seeding
 from runtag.actions import *
-from runtag.entities import Commander, Subordinate
+from runtag.entities import Subordinate
 from runtag.renderer import TextRenderer
 from runtag.utils import l1_distance
 
@@ -147,8 +147,7 @@ class CommanderEnv(SoldierEnv):
     def calculate_reward(self):
         return -sum(l1_distance(self.grid.position_of(self.soldier),
                                 self.grid.position_of(entity))
-                    for entity in self.game.entities(Subordinate)
-                    if self.soldier.is_enemy(entity))
+                    for entity in self.grid.enemies_of(self.soldier, 'subordinate'))
 
     @classmethod
     def from_action(cls, action):
@@ -205,8 +204,7 @@ class SubordinateEnv(SoldierEnv):
     def calculate_reward(self):
         return -sum(l1_distance(self.grid.position_of(self.soldier),
                                 self.grid.position_of(entity))
-                    for entity in self.game.entities(Commander)
-                    if self.soldier.is_enemy(entity))
+                    for entity in self.grid.enemies_of(self.soldier, 'commander'))
 
     @classmethod
     def from_action(cls, action):
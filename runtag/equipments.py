@@ -1,5 +1,5 @@
 from .types import Equipment, Position
-from .station import Message, Station
+from .station import Message
 
 
 class Compass(Equipment):
@@ -17,10 +17,8 @@ class Telescope(Equipment):
                 + [Position(me.x, y) for y in range(self.grid.height)]
 
     def observe(self):
-        for position in self.positions():
-            entities = [entity for entity in self.grid[position] if entity is not self]
-            if entities:
-                yield (position, entities)
+        me = self.grid.position_of(self.owner)
+        yield from self.grid.entities_in_line(me).items()
 
 
 class Radio(Equipment):
@@ -41,7 +39,7 @@ class Radio(Equipment):
 
     @property
     def station(self):
-        return Station.of(self.channel)
+        return self.owner.squad.station
 
     @property
     def channel(self):
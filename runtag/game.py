@@ -12,6 +12,8 @@ class Game:
     def __init__(self, width, height):
         self.grid = Grid(width, height)
         self.camps = OrderedDict()
+        # radio station of every channel, owned by the game
+        self.stations = OrderedDict()
 
     @classmethod
     def make(cls, width, height, number_of_subordinates):
@@ -37,11 +39,19 @@ class Game:
             return game
 
     def spawn(self, squad, commander_position, subordinate_positions):
+        squad.station = self.stations.setdefault(squad.name, Station(squad.name))
         self.grid.add(commander_position, squad.commander)
 
         for subordinate_position, subordinate in zip(subordinate_positions, squad.subordinates):
             self.grid.add(subordinate_position, subordinate)
 
+    def tick(self):
+        """
+        Advance the clocks of the radio stations by one step
+        """
+        for station in self.stations.values():
+            station.tick()
+
     def entities(self, type=object):
         return [entity for entity in self.grid.entities.keys()
                        if isinstance(entity, type)]
@@ -1,19 +1,48 @@
 from collections import OrderedDict
 
-from .entities import Commander, Subordinate
 from .types import Position, as_position
 
 
 class Grid:
+    """
+    Positions of entities kept in flat Python lists.
+
+    Every entity gets an index in the order it is added. `xs` and `ys` hold
+    its position, `camps` and `ranks_of` its squad and rank (-1 for entities
+    that are not soldiers), and `occupancy` counts soldiers of every camp
+    and rank per tile, so tags are lookups instead of scans. `rows` and
+    `columns` list the indexes of the entities in every row and column, and
+    `members` the indexes of the soldiers of every camp by rank, so sights
+    and rewards do not scan the whole grid. `entities` maps every entity to
+    its index.
+
+    A game holds a handful of entities, for which indexing Python lists is
+    cheaper than indexing NumPy arrays.
+    """
+    ranks = ['commander', 'subordinate']
+    max_camps = 4
+    offsets = {
+        'up': (0, -1),
+        'down': (0, +1),
+        'left': (-1, 0),
+        'right': (+1, 0),
+    }
+
     def __init__(self, width, height):
         self.width = width
         self.height = height
 
-        self.tiles = {
-            Position(x, y): set()
-            for x in range(width) for y in range(height)
-        }
         self.entities = OrderedDict()
+        self.squads = []
+        self.xs, self.ys = [], []
+        self.camps, self.ranks_of = [], []
+        self.occupancy = [0] * (self.max_camps * len(self.ranks) * height * width)
+        self.rows = [[] for _ in range(height)]
+        self.columns = [[] for _ in range(width)]
+        self.members = [[[] for _ in self.ranks] for _ in range(self.max_camps)]
+        # Position of every entity, replaced on move, so position_of allocates nothing
+        self._positions = []
+        self._entities = []
 
     def add(self, position, entity):
         position = as_position(position)
@@ -24,19 +53,48 @@ class Grid:
         if not self.within_grid(position):
             raise ValueError('position is out of the grid')
 
-        self.tiles[position].add(entity)
-        self.entities[entity] = position
+        x, y = int(position.x), int(position.y)
+        camp, rank = self._camp_and_rank(entity)
+        index = len(self._entities)
+        self.entities[entity] = index
+        self._entities.append(entity)
+        self._positions.append(Position(x, y))
+        self.xs.append(x)
+        self.ys.append(y)
+        self.camps.append(camp)
+        self.ranks_of.append(rank)
+        self.rows[y].append(index)
+        self.columns[x].append(index)
+        if rank >= 0:
+            self.occupancy[self._tile(camp, rank, x, y)] += 1
+            self.members[camp][rank].append(index)
 
     def move(self, entity, direction):
-        if not self.entity_exists(entity):
+        index = self.entities.get(entity)
+        if index is None:
             raise ValueError('entity is not in the grid')
 
-        position = self.position_of(entity)
-        next_position = getattr(position, direction)().clip(self.width, self.height)
-
-        self.tiles[position].remove(entity)
-        self.tiles[next_position].add(entity)
-        self.entities[entity] = next_position
+        x, y = self.xs[index], self.ys[index]
+        dx, dy = self.offsets[direction]
+        next_x = min(max(x + dx, 0), self.width - 1)
+        next_y = min(max(y + dy, 0), self.height - 1)
+        if (next_x == x) and (next_y == y):
+            return
+
+        self.xs[index], self.ys[index] = next_x, next_y
+        self._positions[index] = Position(next_x, next_y)
+        # a move changes either the row or the column
+        if next_y != y:
+            self.rows[y].remove(index)
+            self.rows[next_y].append(index)
+        else:
+            self.columns[x].remove(index)
+            self.columns[next_x].append(index)
+        rank = self.ranks_of[index]
+        if rank >= 0:
+            tile = self._tile(self.camps[index], rank, x, y)
+            self.occupancy[tile] -= 1
+            self.occupancy[tile + (next_y - y) * self.width + (next_x - x)] += 1
 
     def entity_exists(self, entity):
         return entity in self.entities
@@ -46,9 +104,28 @@ class Grid:
         return ((0 <= position.x < self.width) and (0 <= position.y < self.height))
 
     def entities_at(self, position):
+        """
+        Entities at position in the order they were added
+        """
         if not self.within_grid(position):
             raise ValueError('position is out of the grid')
-        return list(self.tiles[position])
+        x, y = as_position(position)
+        return [self._entities[index] for index in sorted(self.rows[y]) if self.xs[index] == x]
+
+    def entities_in_line(self, position):
+        """
+        Entities in the row and the column of position by tile, with tiles
+        in the order of Telescope.positions: the row from left to right,
+        then the rest of the column from top to bottom
+        """
+        x, y = as_position(position)
+        xs, ys = self.xs, self.ys
+        in_row = sorted((xs[index], index) for index in self.rows[y])
+        in_column = sorted((ys[index], index) for index in self.columns[x] if ys[index] != y)
+        tiles = OrderedDict()
+        for _, index in in_row + in_column:
+            tiles.setdefault(self._positions[index], []).append(self._entities[index])
+        return tiles
 
     def entities_with(self, entity):
         return self.entities_at(self.position_of(entity))
@@ -56,7 +133,50 @@ class Grid:
     def position_of(self, entity):
         if not self.entity_exists(entity):
             raise ValueError('entity is not in the grid')
+        return self._positions[self.entities[entity]]
+
+    def index_of(self, entity):
         return self.entities[entity]
 
+    def enemies_of(self, entity, rank):
+        """
+        Soldiers of rank in the camps other than the one of entity
+        """
+        return [self._entities[index] for index in self.enemy_indexes(self.entities[entity], rank)]
+
+    def enemy_indexes(self, index, rank):
+        """
+        Indexes of the soldiers of rank in the camps other than the one of the entity at index
+        """
+        rank = self.ranks.index(rank)
+        return [other for camp in range(len(self.squads)) if camp != self.camps[index]
+                for other in self.members[camp][rank]]
+
+    def enemies_with(self, entity, rank):
+        """
+        Number of soldiers of rank and of another camp on the tile of entity
+        """
+        index = self.entities[entity]
+        own_camp = self.camps[index]
+        tile = self._tile(0, self.ranks.index(rank), self.xs[index], self.ys[index])
+        stride = len(self.ranks) * self.height * self.width
+        occupancy = self.occupancy
+        return sum(occupancy[camp * stride + tile] for camp in range(len(self.squads)) if camp != own_camp)
+
+    def _tile(self, camp, rank, x, y):
+        return ((camp * len(self.ranks) + rank) * self.height + y) * self.width + x
+
+    def _camp_and_rank(self, entity):
+        squad, rank = getattr(entity, 'squad', None), getattr(entity, 'rank', None)
+        if squad is None or rank not in self.ranks:
+            return -1, -1
+        for camp, other in enumerate(self.squads):
+            if squad is other:
+                return camp, self.ranks.index(rank)
+        if len(self.squads) == self.max_camps:
+            raise ValueError('grid supports at most {} camps'.format(self.max_camps))
+        self.squads.append(squad)
+        return len(self.squads) - 1, self.ranks.index(rank)
+
     def __getitem__(self, position):
-        return self.entities_at(position)
\ No newline at end of file
+        return self.entities_at(position)
@@ -1,15 +1,14 @@
-from collections import namedtuple
-from datetime import datetime
+from collections import deque, namedtuple
 
 
 Message = namedtuple('Message', ['sender', 'payload', 'receiver'])
 
 
 class Envelope:
-    def __init__(self, message, timeout=5):
+    def __init__(self, message, sent_at, timeout):
         self.message = message
-        self.sent_at = datetime.now()
-        self.timeout = timeout
+        self.sent_at = sent_at
+        self.expires_at = sent_at + timeout
 
     @property
     def sender(self):
@@ -19,52 +18,56 @@ class Envelope:
     def receiver(self):
         return self.message.receiver
 
-    @property
-    def expired(self):
-        return (datetime.now() - self.sent_at).total_seconds() >= self.timeout
-
 
 class Station:
-    stations = dict()
+    """
+    Radio messages of one channel of a game, queued per receiver and
+    received first in, first out.
+    The clock counts the steps of the game, advanced by tick, and a message
+    expires timeout steps after it was sent: it can be received on the step
+    it was sent and on the timeout - 1 following ones.
+    """
+    timeout = 5
 
     def __init__(self, channel):
         self.channel = channel
-        self.envelopes = set()
-
-    @classmethod
-    def of(cls, channel):
-        if channel not in cls.stations:
-            cls.stations[channel] = Station(channel)
-        return cls.stations[channel]
+        self.clock = 0
+        self.queues = dict()
 
-    @classmethod
-    def all(cls):
-        return list(cls.stations.values())
+    def tick(self):
+        self.clock += 1
 
     def send(self, sender, payload, receiver):
-        self.discard_expirations()
-        self.envelopes.add(Envelope(Message(sender, payload, receiver)))
+        queue = self.queues.setdefault(receiver, deque())
+        self.discard_expirations([queue])
+        queue.append(Envelope(Message(sender, payload, receiver), self.clock, self.timeout))
 
     def receive(self, sender, receiver, count=0):
-        self.discard_expirations()
-
-        all_senders = sender is None
-        all_receivers = receiver is None
-
-        received = set()
-        for envelope in self.envelopes:
-            if (not all_senders) and (envelope.sender is not sender):
-                continue
-            if (not all_receivers) and (envelope.receiver is not receiver):
-                continue
-            received.add(envelope)
+        if receiver is None:
+            queues = list(self.queues.values())
+        else:
+            queues = [self.queues[receiver]] if receiver in self.queues else []
+        self.discard_expirations(queues)
+
+        received = []
+        for queue in queues:
+            if sender is None:
+                size = len(queue) if count <= 0 else min(len(queue), count - len(received))
+                received.extend(queue.popleft() for _ in range(size))
+            else:
+                for envelope in [envelope for envelope in queue if envelope.sender is sender]:
+                    if (count > 0) and (len(received) >= count):
+                        break
+                    queue.remove(envelope)
+                    received.append(envelope)
 
             if (count > 0) and (len(received) >= count):
                 break
 
-        self.envelopes -= received
         return [envelope.message._asdict() for envelope in received]
 
-    def discard_expirations(self):
-        expired = {envelope for envelope in self.envelopes if envelope.expired}
-        self.envelopes -= expired
\ No newline at end of file
+    def discard_expirations(self, queues=None):
+        # envelopes of a queue are in the order they were sent, so expired ones lead
+        for queue in (self.queues.values() if queues is None else queues):
+            while queue and (queue[0].expires_at <= self.clock):
+                queue.popleft()
@@ -13,16 +13,16 @@ def as_position(value):
 
 class Position(namedtuple('Position', ['x', 'y'])):
     def up(self):
-        return self + Position(0, -1)
+        return Position(self.x, self.y - 1)
 
     def down(self):
-        return self + Position(0, +1)
+        return Position(self.x, self.y + 1)
 
     def left(self):
-        return self + Position(-1, 0)
+        return Position(self.x - 1, self.y)
 
     def right(self):
-        return self + Position(+1, 0)
+        return Position(self.x + 1, self.y)
 
     def clip(self, width, height):
         return Position(x=max(0, min(self.x, width - 1)),
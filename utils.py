@@ -1,9 +1,13 @@
+import _pickle as pickle
 import random
 import io
 from PIL import Image
 
 import numpy as np
 import torch
+import zmq
+
+import wire
 
 
 def print_args(args):
@@ -41,38 +45,112 @@ def png2array(png):
     return rgb_array
 
 
-def compute_loss(model, tgt_model, batch, n_steps, gamma=0.99):
+def compute_loss(model, tgt_model, batch, n_steps, gamma=0.99, prios_buffers=None):
+    """
+    Double DQN loss and priorities of a batch.
+    Only the online pass over states is recorded for backward, next states
+    go through both networks under no_grad. Priorities are written into the
+    next buffer of prios_buffers if given, see PriorityBuffers.
+    """
     states, actions, rewards, next_states, dones, weights = batch
 
     q_values = model(states)
-    next_q_values = model(next_states)
-    tgt_next_q_values = tgt_model(next_states)
+    with torch.no_grad():
+        next_actions = model(next_states).argmax(1, keepdim=True)
+        next_q_a_values = tgt_model(next_states).gather(1, next_actions).squeeze(1)
+        expected_q_a_values = rewards + (gamma ** n_steps) * next_q_a_values * (1 - dones)
 
-    #q_a_values = q_values.gather(1, actions.unsqueeze(1)).squeeze(1)
-    next_actions = next_q_values.max(1)[1].unsqueeze(1)
-    q_a_values = q_values.gather(1, actions).squeeze(1)
-    next_q_a_values = tgt_next_q_values.gather(1, next_actions).squeeze(1)
-    expected_q_a_values = rewards + (gamma ** n_steps) * next_q_a_values * (1 - dones)
+    q_a_values = q_values.gather(1, actions.unsqueeze(1)).squeeze(1)
+    loss = torch.nn.functional.smooth_l1_loss(q_a_values, expected_q_a_values, reduction='none')
+    loss = (loss * weights).mean()
 
-    td_error = torch.abs(expected_q_a_values.detach() - q_a_values)
-    prios = (td_error + 1e-6).data.cpu().numpy()
+    with torch.no_grad():
+        td_error = (expected_q_a_values - q_a_values).abs_().add_(1e-6)
+        if prios_buffers is None:
+            prios = td_error.cpu()
+        else:
+            prios = prios_buffers.next(len(td_error)).copy_(td_error)
+    return loss, prios.numpy()
 
-    loss = torch.where(td_error < 1, 0.5 * td_error ** 2, td_error - 0.5)
-    loss = (loss * weights).mean()
-    return loss, prios
+
+class PriorityBuffers:
+    """
+    Ring of n_buffers preallocated priority arrays for compute_loss.
+    The priorities of a call stay untouched for the next n_buffers - 1
+    calls, so a queue holding up to n_buffers - 1 of them never needs copies.
+    """
+    def __init__(self, n_buffers):
+        self.buffers = None
+        self.n_buffers = n_buffers
+        self.index = 0
+
+    def next(self, batch_size):
+        if self.buffers is None or self.buffers.size(1) != batch_size:
+            self.buffers = torch.empty((self.n_buffers, batch_size), dtype=torch.float32,
+                                       pin_memory=torch.cuda.is_available())
+        buffer = self.buffers[self.index]
+        self.index = (self.index + 1) % self.n_buffers
+        return buffer
 
 
 def update_parameters(loss, model, optimizer, max_norm):
     """
-    Update parameters with loss
+    Update parameters with loss and return the gradient norm before clipping.
+    The norm is the one clip_grad_norm_ computes, left as a tensor on the
+    device so reading it is up to the caller
     """
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
     loss.backward()
-    total_norm = 0.
-    for p in model.parameters():
-        param_norm = p.grad.data.norm(2)
-        total_norm += param_norm ** (1. / 2)
-    total_norm = total_norm ** (1. / 2)
-    torch.nn.utils.clip_grad.clip_grad_norm_(model.parameters(), max_norm)
+    grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm, foreach=True)
     optimizer.step()
-    return total_norm
+    return grad_norm
+
+
+def connect_param_socket(ctx, param_socket, learner_ip, actor_id, port=52001):
+    """
+    Handshake with the learner (see learner.check_connection) and connect
+    param_socket to its parameter port in between
+    """
+    socket = ctx.socket(zmq.REQ)
+    socket.connect("tcp://{}:52002".format(learner_ip))
+    socket.send(pickle.dumps((actor_id, 1)))
+    socket.recv()
+    param_socket.connect('tcp://{}:{}'.format(learner_ip, port))
+    socket.send(pickle.dumps((actor_id, 2)))
+    socket.recv()
+    print("Successfully connected to learner!")
+    socket.close()
+
+
+def encode_params(state_dict, version, precision='fp32'):
+    """
+    Encode model parameters as wire frames stamped with their version.
+    fp16 halves the message, int8 quarters it with one symmetric scale
+    per tensor.
+    """
+    names, dtypes, scales, arrays = [], [], [], []
+    for name, tensor in state_dict.items():
+        array = tensor.detach().cpu().numpy()
+        names.append(name)
+        dtypes.append(array.dtype.str)
+        scale = 1.
+        if array.dtype.kind == 'f' and precision == 'fp16':
+            array = array.astype(np.float16)
+        elif array.dtype.kind == 'f' and precision == 'int8':
+            scale = float(np.abs(array).max()) / 127 or 1.
+            array = np.round(array / scale).astype(np.int8)
+        scales.append(scale)
+        arrays.append(array)
+    return wire.pack(arrays, version=version, names=names, dtypes=dtypes, scales=scales)
+
+
+def decode_params(arrays, meta):
+    """
+    Returns version and state_dict of a message built by encode_params
+    """
+    state_dict = {}
+    for name, dtype, scale, array in zip(meta['names'], meta['dtypes'], meta['scales'], arrays):
+        array = array.astype(dtype) if scale == 1. else (array * scale).astype(dtype)
+        # scaling a 0-d array gives a NumPy scalar
+        state_dict[name] = torch.from_numpy(np.asarray(array))
+    return meta['version'], state_dict
@@ -0,0 +1,500 @@
+"""
+Module for running several RunTag environments in lockstep for actors.
+"""
+import random
+from multiprocessing import Pipe, Process
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+from gym import spaces
+
+from runtag.envs.centralized import RunTagEnv
+from runtag.formation import Formation
+from runtag.grid import Grid
+from runtag.station import Station
+
+
+class VecRunTagEnv:
+    """
+    K RunTagEnv instances stepped in lockstep.
+    Observations are returned per agent as in RunTagEnv: commander
+    observations are flattened and stacked into a (K, obs_dim) float32
+    array, subordinate observations are lists of K dicts. The envs write
+    commander observations straight into rows of one buffer, see
+    RunTagEnv.set_observation_buffers.
+    Environments whose episode is done are reset automatically, so the
+    observations returned for them start the next episode.
+    """
+    def __init__(self, n_envs, width=5, height=5, number_of_subordinates=1, max_steps=None):
+        self.envs = [RunTagEnv(width, height, number_of_subordinates, max_steps) for _ in range(n_envs)]
+        self.n_envs = n_envs
+        env = self.envs[0]
+        self.commander_observation_space = env.commander_observation_space
+        self.commander_action_space = env.commander_action_space
+        self.subordinate_observation_space = env.subordinate_observation_space
+        self.subordinate_action_space = env.subordinate_action_space
+        self.number_of_agents = env.number_of_agents
+        self.number_of_agents_per_camp = env.number_of_agents_per_camp
+        self.observation_size = spaces.utils.flatdim(self.commander_observation_space)
+
+        self._commanders = np.zeros((n_envs, len(RunTagEnv.camps), self.observation_size), dtype=np.float32)
+        for env, commanders in zip(self.envs, self._commanders):
+            env.set_observation_buffers(commanders)
+
+    def seed(self, seed):
+        return [env.seed(seed + i)[0] for i, env in enumerate(self.envs)]
+
+    def reset(self):
+        return self._stack([env.reset() for env in self.envs])
+
+    def reset_at(self, index):
+        """
+        Reset one environment and return the observations of all of them
+        """
+        self._observations[index] = self.envs[index].reset()
+        return self._stack(self._observations)
+
+    def step(self, actions):
+        """
+        Parameters
+        ----------
+        actions: array_like
+            (K, number_of_agents) actions in RunTagEnv order
+        Returns
+        -------
+        observations: list
+            per agent, see VecRunTagEnv
+        rewards: np.array
+            (K, number_of_agents) float32 rewards
+        dones: np.array
+            (K, ) bool, True where the episode ended on this step
+        infos: list of dict
+        """
+        observations = []
+        rewards = np.zeros((self.n_envs, self.number_of_agents), dtype=np.float32)
+        dones = np.zeros(self.n_envs, dtype=bool)
+        infos = []
+        for i, (env, env_actions) in enumerate(zip(self.envs, actions)):
+            env_observations, env_rewards, env_dones, info = env.step(list(env_actions))
+            rewards[i] = env_rewards
+            dones[i] = env_dones[0]
+            if dones[i]:
+                env_observations = env.reset()
+            observations.append(env_observations)
+            infos.append(info)
+        return self._stack(observations), rewards, dones, infos
+
+    def _stack(self, observations):
+        self._observations = observations
+        stacked = []
+        for index in range(self.number_of_agents):
+            camp, rank = divmod(index, self.number_of_agents_per_camp)
+            if rank == 0:
+                # copies, since the envs overwrite their rows on the next step
+                stacked.append(self._commanders[:, camp].copy())
+            else:
+                stacked.append([env_observations[index] for env_observations in observations])
+        return stacked
+
+
+class SubprocRunTagEnv:
+    """
+    K RunTagEnv instances split over worker processes, with the same
+    interface as VecRunTagEnv.
+    Actions go down and observations, rewards, dones and the exceeded flags
+    of infos come back through shared-memory arrays; the pipes to the
+    workers only carry commands.
+    """
+    def __init__(self, n_envs, n_workers, width=5, height=5, number_of_subordinates=1, max_steps=None):
+        env_args = (width, height, number_of_subordinates, max_steps)
+        env = RunTagEnv(*env_args)
+        self.n_envs = n_envs
+        self.commander_observation_space = env.commander_observation_space
+        self.commander_action_space = env.commander_action_space
+        self.subordinate_observation_space = env.subordinate_observation_space
+        self.subordinate_action_space = env.subordinate_action_space
+        self.number_of_agents = env.number_of_agents
+        self.number_of_agents_per_camp = env.number_of_agents_per_camp
+        self.observation_size = spaces.utils.flatdim(self.commander_observation_space)
+
+        self._shapes = _shared_shapes(n_envs, env.number_of_agents, self.observation_size)
+        self._shared = {name: RawArray(np.ctypeslib.as_ctypes_type(dtype), int(np.prod(shape)))
+                        for name, (shape, dtype) in self._shapes.items()}
+        self._arrays = _shared_views(self._shared, self._shapes)
+
+        bounds = np.linspace(0, n_envs, min(n_workers, n_envs) + 1).astype(int).tolist()
+        self._conns, self._procs = [], []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            conn, worker_conn = Pipe()
+            proc = Process(target=_worker, args=(worker_conn, start, stop, env_args, self._shared, self._shapes),
+                           daemon=True)
+            proc.start()
+            self._conns.append(conn)
+            self._procs.append(proc)
+        self._bounds = bounds
+
+    def seed(self, seed):
+        self._call('seed', seed)
+        return [seed + i for i in range(self.n_envs)]
+
+    def reset(self):
+        self._call('reset')
+        return self._observations()
+
+    def reset_at(self, index):
+        worker = np.searchsorted(self._bounds, index, side='right') - 1
+        self._conns[worker].send(('reset_at', index))
+        self._conns[worker].recv()
+        return self._observations()
+
+    def step(self, actions):
+        """See VecRunTagEnv.step"""
+        self._arrays['actions'][...] = actions
+        self._call('step')
+        infos = [dict(exceeded=True) if truncated else dict() for truncated in self._arrays['exceeded']]
+        return self._observations(), self._arrays['rewards'].copy(), self._arrays['dones'].copy(), infos
+
+    def close(self):
+        self._call('close')
+        for proc in self._procs:
+            proc.join()
+
+    def _call(self, command, data=None):
+        for conn in self._conns:
+            conn.send((command, data))
+        for conn in self._conns:
+            conn.recv()
+
+    def _observations(self):
+        # copies, since the shared arrays are overwritten by the next step
+        return _split_observations(self._arrays['commanders'].copy(), self._arrays['subordinates'],
+                                   self.number_of_agents_per_camp)
+
+
+class BatchedRunTagEnv:
+    """
+    K RunTag games simulated together in NumPy arrays, with the interface
+    of VecRunTagEnv.
+    Positions of all agents are kept in a (K, number_of_agents, 2) array in
+    RunTagEnv agent order, and every phase of RunTagEnv.step (commanders in
+    camp order, then subordinates, tags, rewards, max_steps truncation and
+    automatic reset) is computed for all games at once. Games are laid out
+    by Formation with the same calls to the random module as Game.make, so
+    for the same random state and actions they play out as in VecRunTagEnv.
+    Radio messages are queued per subordinate, received first in, first
+    out and expire after Station.timeout steps, as in Station.
+    """
+    def __init__(self, n_envs, width=5, height=5, number_of_subordinates=1, max_steps=None):
+        env = RunTagEnv(width, height, number_of_subordinates, max_steps)
+        self.n_envs = n_envs
+        self.width, self.height = width, height
+        self.number_of_subordinates = number_of_subordinates
+        self.max_steps = max_steps
+        self.commander_observation_space = env.commander_observation_space
+        self.commander_action_space = env.commander_action_space
+        self.subordinate_observation_space = env.subordinate_observation_space
+        self.subordinate_action_space = env.subordinate_action_space
+        self.number_of_agents = env.number_of_agents
+        self.number_of_agents_per_camp = env.number_of_agents_per_camp
+        self.observation_size = spaces.utils.flatdim(self.commander_observation_space)
+
+        self._offsets = env.commander_observation_offsets
+
+        n_camps = len(RunTagEnv.camps)
+        agents = np.arange(self.number_of_agents)
+        self._camps = agents // self.number_of_agents_per_camp
+        self._commanders = agents[agents % self.number_of_agents_per_camp == 0]
+        self._subordinates = agents[agents % self.number_of_agents_per_camp != 0]
+        is_commander = agents % self.number_of_agents_per_camp == 0
+        # commanders are rewarded by their distance to enemy subordinates and the other way around
+        self._targets = ((self._camps[:, None] != self._camps[None])
+                         & (is_commander[:, None] != is_commander[None])).astype(np.int64)
+        # a commander is tagged by an enemy subordinate on its tile
+        self._tags = [(commander, subordinate) for commander in self._commanders.tolist()
+                      for subordinate in self._subordinates.tolist()
+                      if self._camps[commander] != self._camps[subordinate]]
+        # moves of the directions of RunTagEnv, None included
+        self._moves = np.array([(0, 0)] + [Grid.offsets[direction] for direction in RunTagEnv.directions[1:]])
+        self._bounds = np.array([width - 1, height - 1])
+
+        n_subordinates = len(self._subordinates)
+        self.positions = np.zeros((n_envs, self.number_of_agents, 2), dtype=np.int64)
+        self.steps = np.zeros(n_envs, dtype=np.int64)
+        # Commander.position and Commander.observation, (0, 0) and empty until set
+        self.commander_positions = np.zeros((n_envs, n_camps, 2), dtype=np.int64)
+        self.sightings = np.zeros((n_envs, n_camps, 2, height, width), dtype=np.int8)
+        # Subordinate.direction as an index of RunTagEnv.directions
+        self.subordinate_directions = np.zeros((n_envs, n_subordinates), dtype=np.int64)
+        # radio messages per subordinate in ring buffers of direction indexes and the steps they were sent at
+        self._messages = np.zeros((n_envs, n_subordinates, 8), dtype=np.int64)
+        self._sent = np.zeros((n_envs, n_subordinates, 8), dtype=np.int64)
+        self._heads = np.zeros((n_envs, n_subordinates), dtype=np.int64)
+        self._counts = np.zeros((n_envs, n_subordinates), dtype=np.int64)
+
+    def seed(self, seed):
+        # RunTagEnv draws nothing from np_random: games are laid out with
+        # the random module, which the caller seeds as for VecRunTagEnv
+        return [seed + i for i in range(self.n_envs)]
+
+    def reset(self):
+        self._reset_games(np.arange(self.n_envs))
+        return self._observations()
+
+    def reset_at(self, index):
+        """
+        Reset one environment and return the observations of all of them
+        """
+        self._reset_games(np.array([index]))
+        return self._observations()
+
+    def step(self, actions):
+        """See VecRunTagEnv.step"""
+        (commanders, subordinates), rewards, dones, exceeded = self.step_arrays(actions)
+        infos = [dict(exceeded=True) if truncated else dict() for truncated in exceeded]
+        return (_split_observations(commanders, subordinates, self.number_of_agents_per_camp),
+                rewards, dones, infos)
+
+    def step_arrays(self, actions):
+        """
+        step without building observations per agent
+        Parameters
+        ----------
+        actions: array_like
+            (K, number_of_agents) actions in RunTagEnv order
+        Returns
+        -------
+        observations: tuple of np.array
+            (K, camps, obs_dim) float32 flattened commander observations and
+            (K, subordinates, SUBORDINATE_KEYS) int64 subordinate observations
+        rewards: np.array
+            (K, number_of_agents) float32 rewards
+        dones: np.array
+            (K, ) bool, True where the episode ended on this step
+        exceeded: np.array
+            (K, ) bool, True where the episode was cut at max_steps
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        if self.max_steps is not None:
+            exceeded = self.steps >= self.max_steps
+        else:
+            exceeded = np.zeros(self.n_envs, dtype=bool)
+        acting = ~exceeded
+        n_directions = len(RunTagEnv.directions)
+        self._discard_expirations()
+
+        for camp, agent in enumerate(self._commanders):
+            action = actions[:, agent]
+            games = np.flatnonzero(acting & (action >= 1) & (action <= n_directions))
+            self._move(games, np.full(len(games), agent), action[games] - 1)
+            self.commander_positions[games, camp] = self.positions[games, agent]
+
+            games = np.flatnonzero(acting & (action == 0))
+            self.commander_positions[games, camp] = self.positions[games, agent]
+            self._observe(games, camp)
+
+            games = np.flatnonzero(acting & (action > n_directions))
+            index = action[games] - 1 - n_directions
+            self._send(games, camp * self.number_of_subordinates + index // n_directions, index % n_directions)
+
+        action = actions[:, self._subordinates]
+        self._listen(acting[:, None] & (action == 0))
+        moving = acting[:, None] & (action > 0)
+        games, subordinates = np.nonzero(moving)
+        self._move(games, self._subordinates[subordinates], action[games, subordinates] - 1)
+        self.subordinate_directions[moving] = 0
+
+        self.steps[acting] += 1
+        distances = np.abs(self.positions[:, :, None] - self.positions[:, None]).sum(-1)
+        rewards = -(distances * self._targets).sum(-1).astype(np.float32)
+        dones = exceeded | self._tagged(self.positions).any(-1)
+        self._reset_games(np.flatnonzero(dones))
+        return self._arrays(), rewards, dones, exceeded
+
+    def _reset_games(self, games):
+        if len(games) == 0:
+            return
+        # in game order, which is the order VecRunTagEnv resets in
+        self.positions[games] = [self._place() for _ in games]
+        self.steps[games] = 0
+        self.commander_positions[games] = 0
+        self.sightings[games] = 0
+        self.subordinate_directions[games] = 0
+        self._heads[games] = 0
+        self._counts[games] = 0
+
+    def _place(self):
+        """
+        Positions of a new game, drawn as by Game.make
+        """
+        formation = Formation(Grid(self.width, self.height))
+        while True:
+            positioner = formation.place(number_of_camps=len(RunTagEnv.camps),
+                                         number_of_soldiers=self.number_of_agents_per_camp)
+            positions = [position for squad in positioner for position in squad]
+            if not any(positions[commander] == positions[subordinate] for commander, subordinate in self._tags):
+                return positions
+
+    def _tagged(self, positions):
+        """
+        (games, camps) bool, True where the commander shares its tile with an enemy subordinate
+        """
+        commanders = positions[:, self._commanders]
+        subordinates = positions[:, self._subordinates]
+        met = (commanders[:, :, None] == subordinates[:, None]).all(-1)
+        enemies = self._camps[self._commanders][:, None] != self._camps[self._subordinates][None]
+        return (met & enemies).any(-1)
+
+    def _move(self, games, agents, directions):
+        moved = self.positions[games, agents] + self._moves[directions]
+        self.positions[games, agents] = np.minimum(np.maximum(moved, 0), self._bounds)
+
+    def _observe(self, games, camp):
+        """
+        Telescope of the commanders of camp in games: the ranks seen in their row
+        and column, where the entity added last to the grid wins shared tiles
+        """
+        sightings = np.zeros((len(games), 2, self.height, self.width), dtype=np.int8)
+        observer = self.positions[games, self._commanders[camp]]
+        for agent in range(self.number_of_agents):
+            position = self.positions[games, agent]
+            seen = np.flatnonzero((position == observer).any(-1))
+            rank = 0 if agent in self._commanders else 1
+            sightings[seen, rank, position[seen, 1], position[seen, 0]] = +1 if self._camps[agent] == camp else -1
+        self.sightings[games, camp] = sightings
+
+    def _send(self, games, subordinates, payloads):
+        if (self._counts[games, subordinates] == self._messages.shape[-1]).any():
+            self._grow_messages()
+        capacity = self._messages.shape[-1]
+        slots = (self._heads[games, subordinates] + self._counts[games, subordinates]) % capacity
+        self._messages[games, subordinates, slots] = payloads
+        self._sent[games, subordinates, slots] = self.steps[games]
+        self._counts[games, subordinates] += 1
+
+    def _listen(self, listening):
+        games, subordinates = np.nonzero(listening & (self._counts > 0))
+        self.subordinate_directions[listening] = 0
+        heads = self._heads[games, subordinates]
+        self.subordinate_directions[games, subordinates] = self._messages[games, subordinates, heads]
+        self._heads[games, subordinates] = (heads + 1) % self._messages.shape[-1]
+        self._counts[games, subordinates] -= 1
+
+    def _discard_expirations(self):
+        if not self._counts.any():
+            return
+        capacity = self._messages.shape[-1]
+        queued = (np.arange(capacity) - self._heads[..., None]) % capacity < self._counts[..., None]
+        expired = (queued & (self._sent + Station.timeout <= self.steps[:, None, None])).sum(-1)
+        self._heads = (self._heads + expired) % capacity
+        self._counts -= expired
+
+    def _grow_messages(self):
+        capacity = self._messages.shape[-1]
+        order = (self._heads[..., None] + np.arange(capacity)) % capacity
+        for name in ('_messages', '_sent'):
+            grown = np.zeros(self._messages.shape[:-1] + (2 * capacity, ), dtype=np.int64)
+            grown[..., :capacity] = np.take_along_axis(getattr(self, name), order, -1)
+            setattr(self, name, grown)
+        self._heads[...] = 0
+
+    def _arrays(self):
+        n_camps = self.commander_positions.shape[1]
+        area = self.height * self.width
+        commanders = np.zeros((self.n_envs, n_camps, self.observation_size), dtype=np.float32)
+        for key, rank in (('commanders', 0), ('subordinates', 1)):
+            offset = self._offsets[key]
+            commanders[..., offset:offset + area] = self.sightings[:, :, rank].reshape(self.n_envs, n_camps, area)
+        games, camps = np.arange(self.n_envs)[:, None], np.arange(n_camps)[None]
+        offset = self._offsets['position']
+        commanders[games, camps, offset + self.commander_positions[..., 0]] = 1
+        commanders[games, camps, offset + self.width + self.commander_positions[..., 1]] = 1
+        commanders[games, camps, self._offsets['squad'] + camps] = 1
+
+        subordinates = np.empty((self.n_envs, len(self._subordinates), len(SUBORDINATE_KEYS)), dtype=np.int64)
+        subordinates[..., 0] = self._camps[self._subordinates]
+        subordinates[..., 1] = self._subordinates % self.number_of_agents_per_camp - 1
+        subordinates[..., 2] = self.subordinate_directions
+        return commanders, subordinates
+
+    def _observations(self):
+        return _split_observations(*self._arrays(), self.number_of_agents_per_camp)
+
+
+SUBORDINATE_KEYS = ('squad', 'identifier', 'direction')
+
+
+def _split_observations(commanders, subordinates, number_of_agents_per_camp):
+    """
+    Observations per agent as returned by VecRunTagEnv from (K, camps, obs_dim)
+    flattened commander observations and (K, subordinates, SUBORDINATE_KEYS)
+    subordinate observations
+    """
+    observations = []
+    for index in range(commanders.shape[1] * number_of_agents_per_camp):
+        camp, rank = divmod(index, number_of_agents_per_camp)
+        if rank == 0:
+            observations.append(commanders[:, camp])
+        else:
+            column = subordinates[:, camp * (number_of_agents_per_camp - 1) + rank - 1].tolist()
+            observations.append([dict(zip(SUBORDINATE_KEYS, observation)) for observation in column])
+    return observations
+
+
+def _shared_shapes(n_envs, number_of_agents, observation_size):
+    n_commanders = len(RunTagEnv.camps)
+    return {
+        'commanders': ((n_envs, n_commanders, observation_size), np.float32),
+        'subordinates': ((n_envs, number_of_agents - n_commanders, len(SUBORDINATE_KEYS)), np.int64),
+        'actions': ((n_envs, number_of_agents), np.int64),
+        'rewards': ((n_envs, number_of_agents), np.float32),
+        'dones': ((n_envs, ), np.bool_),
+        'exceeded': ((n_envs, ), np.bool_),
+    }
+
+
+def _shared_views(shared, shapes):
+    return {name: np.frombuffer(shared[name], dtype=dtype).reshape(shape)
+            for name, (shape, dtype) in shapes.items()}
+
+
+def _worker(conn, start, stop, env_args, shared, shapes):
+    """
+    Step envs start..stop of a SubprocRunTagEnv on the commands from conn
+    """
+    envs = [RunTagEnv(*env_args) for _ in range(start, stop)]
+    arrays = _shared_views(shared, shapes)
+    for i, env in enumerate(envs, start):
+        env.set_observation_buffers(arrays['commanders'][i])
+    # games are laid out with the random module, whose state forked workers share
+    random.seed()
+
+    def write(i, observations):
+        # commander observations are already written by the env
+        env = envs[i - start]
+        arrays['subordinates'][i] = [[observation[key] for key in SUBORDINATE_KEYS]
+                                     for index, observation in enumerate(observations)
+                                     if index % env.number_of_agents_per_camp != 0]
+
+    while True:
+        command, data = conn.recv()
+        if command == 'step':
+            for i, env in enumerate(envs, start):
+                observations, rewards, dones, info = env.step(arrays['actions'][i].tolist())
+                arrays['rewards'][i] = rewards
+                arrays['dones'][i] = dones[0]
+                arrays['exceeded'][i] = info.get('exceeded', False)
+                if dones[0]:
+                    observations = env.reset()
+                write(i, observations)
+        elif command == 'reset':
+            for i, env in enumerate(envs, start):
+                write(i, env.reset())
+        elif command == 'reset_at':
+            write(data, envs[data - start].reset())
+        elif command == 'seed':
+            random.seed(data + start)
+            for i, env in enumerate(envs, start):
+                env.seed(data + i)
+        conn.send(None)
+        if command == 'close':
+            break
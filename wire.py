@@ -0,0 +1,84 @@
+"""
+Module for the framed binary message format shared by actors, replay and learner.
+
+A message is one JSON header frame followed by one frame per NumPy array.
+The header lists dtype and shape of every array plus a few scalar fields.
+Arrays are sent from their own memory and rebuilt on the receiving side
+with np.frombuffer on the zmq.Frame buffers, so neither side copies them.
+"""
+import json
+
+import numpy as np
+
+
+def pack(arrays, **meta):
+    """
+    Build the frames of a message.
+    Parameters
+    ----------
+    arrays: list of array_like
+        arrays to send, converted to contiguous NumPy arrays if necessary
+    meta: dict
+        JSON serializable scalar fields
+    Returns
+    -------
+    frames: list
+        header frame followed by the array buffers, for send_multipart(copy=False)
+    """
+    arrays = [np.asarray(array, order='C') for array in arrays]
+    header = {
+        'arrays': [(array.dtype.str, array.shape) for array in arrays],
+        'meta': meta,
+    }
+    return [json.dumps(header).encode()] + arrays
+
+
+def unpack(frames):
+    """
+    Rebuild the arrays of a message without copying them.
+    Parameters
+    ----------
+    frames: list of zmq.Frame or bytes
+        frames as returned by recv_multipart, without routing frames
+    Returns
+    -------
+    arrays: list of np.array
+        read-only views on the frame buffers
+    meta: dict
+        scalar fields of the message
+    """
+    header, *buffers = frames
+    header = json.loads(_buffer_of(header).tobytes())
+    arrays = []
+    for (dtype, shape), buffer in zip(header['arrays'], buffers):
+        arrays.append(np.frombuffer(_buffer_of(buffer), dtype=dtype).reshape(shape))
+    return arrays, header['meta']
+
+
+def _buffer_of(frame):
+    return frame.buffer if hasattr(frame, 'buffer') else memoryview(frame)
+
+
+def join(frames):
+    """
+    Concatenate the frames of a message into a single frame, for sockets
+    that cannot carry multipart messages (SUB with CONFLATE)
+    """
+    header, *arrays = frames
+    buffers = [memoryview(np.asarray(array, order='C')).cast('B') for array in arrays]
+    return b''.join([len(header).to_bytes(4, 'little'), header] + buffers)
+
+
+def split(frame):
+    """
+    Inverse of join: frames of the message as views on the single frame
+    """
+    buffer = _buffer_of(frame)
+    size = int.from_bytes(buffer[:4], 'little')
+    header, offset = buffer[4:4 + size], 4 + size
+    frames = [header]
+    for dtype, shape in json.loads(header.tobytes())['arrays']:
+        nbytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+        frames.append(buffer[offset:offset + nbytes])
+        offset += nbytes
+    return frames